@@ -0,0 +1,828 @@
+#!/usr/bin/env python
+
+"""
+Filename: chartparser.py
+
+Polynomial time chart parsers for grammars read with grammar.PSG:
+
+EarleyParser: Earley's algorithm for any context free grammar, with
+left-corner filtering of predictions and the nullable-symbol handling
+of Aycock and Horspool (2002).
+
+CYKParser: the Cocke-Younger-Kasami algorithm for grammars in Chomsky
+Normal Form, i.e. with rules of the form A -> B C and A -> word only.
+
+ViterbiParser: probabilistic CKY for grammars in Chomsky Normal Form with
+rule probabilities, with lazy k-best extraction and beam pruning.
+
+The parsers can also return a ParseForest with all the analyses of the
+tokens, a shared packed parse forest of polynomial size (for grammars
+without unary or empty rule cycles), from which the trees can be counted,
+enumerated lazily or picked by number.
+
+Both take a PSG or its CompiledPSG (grammar.PSG.compile()) and work on
+the integer symbols and rule arrays of the compiled form. They return
+parse trees as nested tuples (label, child, ...), with the words as
+leaves, e.g.:
+
+	("S", ("NP", ("N", "John")), ("VP", ("V", "loves"), ("NP", ("N", "Mary"))))
+
+Example:
+
+	from grammar import PSG
+	from chartparser import EarleyParser, treeToString
+
+	parser = EarleyParser(PSG("mygrammar.txt"))
+	for tree in parser.parse("John loves Mary".split()):
+		print(treeToString(tree))
+"""
+
+import heapq
+import math
+from array import array
+
+import numpy as np
+
+
+def treeToString(tree):
+	"""Return the bracketed string representation of a tree."""
+	if isinstance(tree, tuple):
+		return "(" + " ".join([tree[0]] + [treeToString(x) for x in tree[1:]]) + ")"
+	return tree
+
+
+class ParseForest:
+	"""
+	Shared packed parse forest.
+
+	Every node stands for a span i ... j - 1 of the tokens: a symbol, or,
+	in forests of Earley parses, an intermediate node for the prefix of a
+	rule that was recognized over the span. Every constituent is stored
+	once (sharing), with its alternative analyses in the same node
+	(packing), such that the size of the forest is polynomial in the
+	length of the sentence, while the number of trees can be exponential.
+	The constituents on unary or empty rule cycles are the exception, they
+	are stored once for every path they are reached on (see build).
+
+	The nodes are numbered such that the children of a node have lower
+	numbers, the root is the last node. label, start and end are arrays
+	with the symbol numbers of the compiled grammar (-1 for intermediate
+	nodes) and the spans of the nodes. The alternatives of the node n are
+	nodeAlternatives[n] ... nodeAlternatives[n + 1] - 1, the children of
+	the alternative a are children[alternativeChildren[a]:alternativeChildren[a + 1]].
+	Terminals are the leaves, with no alternatives. In the trees, the
+	children of an intermediate node replace the node.
+	"""
+
+	def __init__(self, grammar, tokens, label, start, end, alternatives):
+		"""Make the forest from the lists of the label, start and end of the
+		nodes, and of the list of the alternatives of every node, tuples of
+		the node numbers of the children."""
+		self.grammar = grammar
+		self.tokens = tuple(tokens)
+		self.label = array("i", label)
+		self.start = array("i", start)
+		self.end = array("i", end)
+		self.nodeAlternatives = array("i", [0])
+		self.alternativeChildren = array("i", [0])
+		self.children = array("i")
+		for packed in alternatives:
+			for children in packed:
+				self.children.extend(children)
+				self.alternativeChildren.append(len(self.children))
+			self.nodeAlternatives.append(len(self.alternativeChildren) - 1)
+		self.root = len(self.label) - 1 if len(self.label) else None
+		self._counts = None
+
+	@classmethod
+	def build(cls, grammar, tokens, root, expand):
+		"""Make the forest of the nodes that can be reached from the root
+		key. expand(key) returns (label, start, end, alternatives) for the
+		key of a node, with the alternatives as lists of the keys of the
+		children. The trees in which a symbol node repeats on a path from
+		the root, i.e. cyclic derivations, are left out, as well as the
+		nodes without trees.
+
+		The nodes that are not on a cycle are shared. Which trees of a node
+		on a cycle are left out depends on the path it is reached on, such
+		that it is expanded again, as a new node, on every path, and the
+		forest of a grammar with unary or empty rule cycles can be much
+		larger."""
+		numbers = {}
+		active = {}   # the symbol keys on the path and their depths
+		opened = {}   # the same for the intermediate keys, not cut
+		label = []
+		start = []
+		end = []
+		alternatives = []
+
+		# depth-first without recursion: the frames of the nodes that are
+		# being expanded, [key, label, start, end, alternatives (lists of
+		# the keys of the children), next alternative, next child, numbers
+		# of the children so far, the alternatives without cycles, the
+		# lowest depth on the path that a cycle below leads back to]; a
+		# node is numbered after its children
+		stack = []
+		n = None
+
+		def push(key):
+			(x, i, j, keys) = expand(key)
+			low = len(stack) + 1
+			if x >= 0:
+				active[key] = len(stack)
+			elif key in opened:
+				# an intermediate node again, the nodes from there on
+				# are on a cycle
+				low = opened[key]
+			else:
+				opened[key] = len(stack)
+			stack.append([key, x, i, j, list(keys), 0, 0, [], [], low])
+
+		def advance(frame, n):
+			# go on with the next child, or with the next alternative if
+			# the child has no trees on this path
+			if n is None:
+				frame[5] += 1
+				frame[6] = 0
+				frame[7] = []
+			else:
+				frame[7].append(n)
+				frame[6] += 1
+
+		if root is not None:
+			push(root)
+		while stack:
+			frame = stack[-1]
+			(key, x, i, j, keys, a, c, numbered, packed, low) = frame
+			if a < len(keys):
+				children = keys[a]
+				if c < len(children):
+					child = children[c]
+					if child in numbers:
+						advance(frame, numbers[child])
+					elif child in active:
+						# a cycle back to the node at that depth
+						frame[9] = min(low, active[child])
+						advance(frame, None)
+					else:
+						# expand the child first, then come back to it
+						push(child)
+					continue
+				packed.append(tuple(numbered))
+				frame[5] = a + 1
+				frame[6] = 0
+				frame[7] = []
+				continue
+			stack.pop()
+			depth = len(stack)
+			if x >= 0:
+				del active[key]
+			elif opened[key] == depth:
+				del opened[key]
+			if packed or (x >= 0 and grammar.isTerminal(x)):
+				n = len(label)
+				label.append(x)
+				start.append(i)
+				end.append(j)
+				alternatives.append(packed)
+			else:
+				n = None
+			if low > depth:
+				# not on a cycle: the same on every path
+				numbers[key] = n
+			if stack:
+				stack[-1][9] = min(stack[-1][9], low)
+				advance(stack[-1], n)
+
+		if n is None:
+			(label, start, end, alternatives) = ([], [], [], [])
+		return cls(grammar, tokens, label, start, end, alternatives)
+
+	def __len__(self):
+		"""Return the number of nodes."""
+		return len(self.label)
+
+	def isLeaf(self, n):
+		"""Return True if the node n is a terminal."""
+		return self.label[n] >= 0 and self.grammar.isTerminal(self.label[n])
+
+	def getAlternatives(self, n):
+		"""Return the list of the alternatives of node n, as tuples of the
+		numbers of their children."""
+		return [tuple(self.children[self.alternativeChildren[a]:self.alternativeChildren[a + 1]])
+			for a in range(self.nodeAlternatives[n], self.nodeAlternatives[n + 1])]
+
+	def counts(self):
+		"""Return the list of the number of trees of every node, computed
+		once, without enumerating the trees."""
+		if self._counts is None:
+			counts = []
+			for n in range(len(self.label)):
+				if self.isLeaf(n):
+					counts.append(1)
+					continue
+				total = 0
+				for a in range(self.nodeAlternatives[n], self.nodeAlternatives[n + 1]):
+					product = 1
+					for c in self.children[self.alternativeChildren[a]:self.alternativeChildren[a + 1]]:
+						product *= counts[c]
+					total += product
+				counts.append(total)
+			self._counts = counts
+		return self._counts
+
+	def count(self, n=None):
+		"""Return the number of trees of node n, by default of the root."""
+		if n is None:
+			n = self.root
+		if n is None:
+			return 0
+		return self.counts()[n]
+
+	def trees(self, n=None):
+		"""Return a generator over the trees of node n, by default of the
+		root, in the order of their numbers (see tree)."""
+		if n is None:
+			n = self.root
+		if n is None:
+			return iter(())
+		return (self._unrank(n, index) for index in range(self.count(n)))
+
+	def tree(self, index, n=None):
+		"""Return the tree number index (0 ... count(n) - 1) of node n, by
+		default of the root, without enumerating the trees before it. The
+		alternatives of a node are taken in their order, and for the
+		children of an alternative the later children vary fastest."""
+		if n is None:
+			n = self.root
+		if n is None or not 0 <= index < self.count(n):
+			raise IndexError("parse forest tree index out of range")
+		return self._unrank(n, index)
+
+	def _choose(self, n, index):
+		"""Return the frame [node, children, next child, number of the
+		subtrees of the children from the next one on, index of the subtree
+		within them, subtrees so far] for the tree number index of node n."""
+		counts = self.counts()
+		for a in range(self.nodeAlternatives[n], self.nodeAlternatives[n + 1]):
+			nodes = self.children[self.alternativeChildren[a]:self.alternativeChildren[a + 1]]
+			product = 1
+			for c in nodes:
+				product *= counts[c]
+			if index < product:
+				return [n, nodes, 0, product, index, []]
+			index -= product
+
+	def _unrank(self, n, index):
+		"""Return the tree number index of a symbol node, or the list of the
+		subtrees number index of an intermediate node, without recursion."""
+		if self.isLeaf(n):
+			return self.tokens[self.start[n]]
+		counts = self.counts()
+		stack = [self._choose(n, index)]
+		while True:
+			frame = stack[-1]
+			(n, nodes, i, product, index, children) = frame
+			if i < len(nodes):
+				c = nodes[i]
+				product //= counts[c]
+				frame[2] = i + 1
+				frame[3] = product
+				frame[4] = index % product
+				if self.isLeaf(c):
+					children.append(self.tokens[self.start[c]])
+				else:
+					stack.append(self._choose(c, index // product))
+				continue
+			stack.pop()
+			subtree = children if self.label[n] < 0 else (self.grammar.symbols[self.label[n]],) + tuple(children)
+			if not stack:
+				return subtree
+			if self.label[n] < 0:
+				stack[-1][5].extend(subtree)
+			else:
+				stack[-1][5].append(subtree)
+
+	def prune(self, keep):
+		"""Return a new forest without the symbol nodes for which the
+		function keep(symbol, start, end) returns False, without the
+		alternatives that use them, and without the nodes that are left
+		without alternatives or cannot be reached from the root."""
+		alive = []
+		packed = []
+		for n in range(len(self.label)):
+			if self.label[n] >= 0 and not keep(self.grammar.symbols[self.label[n]], self.start[n], self.end[n]):
+				alive.append(False)
+				packed.append([])
+				continue
+			alternatives = [x for x in self.getAlternatives(n) if all(alive[c] for c in x)]
+			alive.append(self.isLeaf(n) or len(alternatives) > 0)
+			packed.append(alternatives)
+		reachable = [False] * len(self.label)
+		if self.root is not None and alive[self.root]:
+			reachable[self.root] = True
+		for n in range(len(self.label) - 1, -1, -1):
+			if reachable[n]:
+				for x in packed[n]:
+					for c in x:
+						reachable[c] = True
+		numbers = {}
+		for n in range(len(self.label)):
+			if reachable[n]:
+				numbers[n] = len(numbers)
+		nodes = sorted(numbers)
+		return ParseForest(self.grammar, self.tokens,
+			[self.label[n] for n in nodes], [self.start[n] for n in nodes], [self.end[n] for n in nodes],
+			[[tuple(numbers[c] for c in x) for x in packed[n]] for n in nodes])
+
+
+class EarleyChart:
+	"""
+	The chart of an Earley parse of a list of tokens.
+
+	words are the tokens, tokens their symbol numbers in the compiled
+	grammar (-1 for unknown words). An item is a tuple (rule, dot, origin)
+	for the rule number with the dot before the symbol dot of its
+	right-hand-side, started at position origin. items[k] lists the items
+	that end at position k, in the order they were added; links[k] maps
+	every item that ends at k to the ordered set (a dictionary) of its
+	links (predecessor, child): the predecessor item ends where the child
+	starts, the child is a span (symbol, start, end) of a word or of a
+	complete constituent. complete[k] maps (lhs, origin) to the list of the
+	complete items for lhs from origin to k.
+	"""
+
+	def __init__(self, words, tokens):
+		self.words = tuple(words)
+		self.tokens = tuple(tokens)
+		n = len(self.tokens)
+		self.items = [[] for i in range(n + 1)]
+		self.links = [{} for i in range(n + 1)]
+		self.complete = [{} for i in range(n + 1)]
+		self.waiting = [{} for i in range(n + 1)]
+
+	def add(self, k, item, link=None):
+		"""Add an item that ends at position k, or a link to an existing one."""
+		links = self.links[k].get(item)
+		if links is None:
+			links = {}
+			self.links[k][item] = links
+			self.items[k].append(item)
+		if link is not None:
+			links[link] = None
+
+
+class EarleyParser:
+	"""
+	Earley parser for a PSG, run on its compiled form.
+
+	The grammar indexes are used to predict only the rules that can start
+	with the next token: a non-terminal is predicted only if the token is
+	one of its left corners (or the non-terminal is nullable), and rules
+	with a terminal as first symbol are looked up by that terminal.
+	"""
+
+	def __init__(self, grammar, start=None):
+		if hasattr(grammar, "compile"):
+			grammar = grammar.compile()
+		self.grammar = grammar
+		self.start = grammar.start if start is None else grammar.intern(start)
+
+		# the rules of every non-terminal with an empty right-hand-side or
+		# a non-terminal as first symbol, and the rules with a terminal as
+		# first symbol by (lhs, terminal)
+		self.ntrules = {}
+		self.trules = {}
+		for lhs in range(grammar.nonterminals):
+			for rule in grammar.getRules(lhs):
+				if grammar.ruleLength(rule) > 0 and grammar.isTerminal(grammar.rhs[grammar.rhsStart[rule]]):
+					self.trules.setdefault((lhs, grammar.rhs[grammar.rhsStart[rule]]), []).append(rule)
+				else:
+					self.ntrules.setdefault(lhs, []).append(rule)
+
+	def _viable(self, rule, token):
+		"""Return True if a rule can derive a string that starts with token
+		(-1 at the end of the input or for an unknown word)."""
+		g = self.grammar
+		for i in range(g.rhsStart[rule], g.rhsStart[rule + 1]):
+			x = g.rhs[i]
+			if x == token or token in g.LC[x]:
+				return True
+			if not g.nullable[x]:
+				return False
+		return True
+
+	def _predict(self, chart, k, symbol):
+		"""Add the rules for symbol that can start at position k."""
+		g = self.grammar
+		token = chart.tokens[k] if k < len(chart.tokens) else -1
+		if not g.nullable[symbol] and token not in g.LC[symbol]:
+			return
+		for rule in self.ntrules.get(symbol, ()):
+			if self._viable(rule, token):
+				chart.add(k, (rule, 0, k))
+		for rule in self.trules.get((symbol, token), ()):
+			chart.add(k, (rule, 0, k))
+
+	def chart(self, tokens):
+		"""Run the parser over the list of tokens and return the chart."""
+		g = self.grammar
+		chart = EarleyChart(tokens, [g.intern(x) for x in tokens])
+		n = len(chart.tokens)
+		if self.start < 0:
+			return chart
+		self._predict(chart, 0, self.start)
+		for k in range(n + 1):
+			predicted = set()
+			items = chart.items[k]
+			waiting = chart.waiting[k]
+			i = 0
+			while i < len(items):
+				item = items[i]
+				i += 1
+				(rule, dot, origin) = item
+				if g.rhsStart[rule] + dot < g.rhsStart[rule + 1]:
+					symbol = g.rhs[g.rhsStart[rule] + dot]
+					if symbol >= g.nonterminals:
+						# SCAN: the next token is the expected terminal
+						if k < n and chart.tokens[k] == symbol:
+							chart.add(k + 1, (rule, dot + 1, origin), (item, (symbol, k, k + 1)))
+						continue
+					# PREDICT the rules of the expected non-terminal, and
+					# move the dot over it right away if it is nullable
+					waiting.setdefault(symbol, []).append(item)
+					if symbol not in predicted:
+						predicted.add(symbol)
+						self._predict(chart, k, symbol)
+					if g.nullable[symbol]:
+						chart.add(k, (rule, dot + 1, origin), (item, (symbol, k, k)))
+				else:
+					# COMPLETE the items that were waiting for lhs at origin;
+					# they are advanced once per (lhs, origin)
+					lhs = g.ruleLHS[rule]
+					complete = chart.complete[k].setdefault((lhs, origin), [])
+					complete.append(item)
+					if len(complete) > 1:
+						continue
+					for w in chart.waiting[origin].get(lhs, ()):
+						chart.add(k, (w[0], w[1] + 1, w[2]), (w, (lhs, origin, k)))
+		return chart
+
+	def recognize(self, tokens):
+		"""Return True if the grammar accepts the list of tokens."""
+		chart = self.chart(tokens)
+		return (self.start, 0) in chart.complete[len(chart.tokens)]
+
+	def parse(self, tokens):
+		"""Return a generator over the parse trees of the list of tokens.
+		Trees with cyclic unary or empty derivations are skipped. The trees
+		are enumerated from the parse forest, without recursion."""
+		return self.forest(tokens).trees()
+
+	def forest(self, tokens):
+		"""Return the ParseForest of the list of tokens. The keys of the
+		nodes are the spans (symbol, i, j) and, for the intermediate nodes,
+		the pairs (item, end) of the items with the dot after the first
+		symbol or further."""
+		chart = self.chart(tokens)
+		g = self.grammar
+
+		def alternatives(item, k):
+			if item[1] == 0:
+				return [[]]
+			result = []
+			for (predecessor, (symbol, i, j)) in chart.links[k][item]:
+				if predecessor[1] == 0:
+					result.append([(symbol, i, j)])
+				else:
+					result.append([(predecessor, i), (symbol, i, j)])
+			return result
+
+		def expand(key):
+			if len(key) == 2:
+				(item, k) = key
+				return (-1, item[2], k, alternatives(item, k))
+			(label, i, j) = key
+			if label >= g.nonterminals:
+				return (label, i, j, [])
+			result = []
+			for item in chart.complete[j].get((label, i), ()):
+				result.extend(alternatives(item, j))
+			return (label, i, j, result)
+
+		root = (self.start, 0, len(chart.tokens)) if self.start >= 0 else None
+		return ParseForest.build(g, chart.words, root, expand)
+
+
+class CYKParser:
+	"""
+	CYK parser for a PSG in Chomsky Normal Form, run on its compiled form.
+
+	Binary rules are looked up by their first right-hand-side symbol in the
+	FIRST index of the grammar, for every label in the left cell. The
+	start symbol can have a rule for the empty string, empty is its rule
+	number (None if there is none).
+	"""
+
+	def __init__(self, grammar, start=None):
+		if hasattr(grammar, "compile"):
+			grammar = grammar.compile()
+		self.grammar = grammar
+		self.start = grammar.start if start is None else grammar.intern(start)
+		self.empty = None
+		for rule in range(len(grammar)):
+			rhs = grammar.getRHS(rule)
+			if len(rhs) == 0 and grammar.ruleLHS[rule] == self.start:
+				self.empty = rule
+				continue
+			if len(rhs) == 2 and not (grammar.isTerminal(rhs[0]) or grammar.isTerminal(rhs[1])):
+				continue
+			if len(rhs) == 1 and grammar.isTerminal(rhs[0]):
+				continue
+			raise ValueError("Grammar is not in CNF: " + grammar.symbols[grammar.ruleLHS[rule]] + " -> " + " ".join(grammar.symbols[x] for x in rhs))
+
+	def chart(self, tokens):
+		"""Run the parser over the list of tokens and return the chart, a
+		dictionary that maps the spans (i, j) to dictionaries from label
+		numbers to the lists of their backpointers: (word,) for lexical
+		rules and (k, B, C) for binary rules."""
+		g = self.grammar
+		tokens = tuple(tokens)
+		n = len(tokens)
+		chart = {}
+		for i in range(n):
+			cell = chart[(i, i + 1)] = {}
+			for rule in g.getRulesByRHS((g.intern(tokens[i]),)):
+				cell[g.ruleLHS[rule]] = [(tokens[i],)]
+		for length in range(2, n + 1):
+			for i in range(n - length + 1):
+				j = i + length
+				cell = chart[(i, j)] = {}
+				for k in range(i + 1, j):
+					left = chart[(i, k)]
+					right = chart[(k, j)]
+					if not left or not right:
+						continue
+					for b in left:
+						for rule in g.getRulesByFirst(b):
+							c = g.rhs[g.rhsStart[rule] + 1]
+							if c in right:
+								cell.setdefault(g.ruleLHS[rule], []).append((k, b, c))
+		return chart
+
+	def recognize(self, tokens):
+		"""Return True if the grammar accepts the list of tokens."""
+		tokens = tuple(tokens)
+		if not tokens:
+			return self.empty is not None
+		return self.start in self.chart(tokens)[(0, len(tokens))]
+
+	def parse(self, tokens):
+		"""Return a generator over the parse trees of the list of tokens,
+		enumerated from the parse forest."""
+		tokens = tuple(tokens)
+		if not tokens:
+			return iter([(self.grammar.symbols[self.start],)] if self.empty is not None else [])
+		return self.forest(tokens).trees()
+
+	def forest(self, tokens):
+		"""Return the ParseForest of the list of tokens."""
+		tokens = tuple(tokens)
+		if not tokens or self.start < 0:
+			return ParseForest.build(self.grammar, tokens, None, None)
+		return ParseForest.build(self.grammar, tokens, (self.start, 0, len(tokens)), self._expander(self.chart(tokens), tokens))
+
+	def _expander(self, chart, tokens):
+		"""Return the function that expands the nodes (label, i, j) of the
+		forest of a chart."""
+		g = self.grammar
+
+		def expand(key):
+			(label, i, j) = key
+			result = []
+			if label < g.nonterminals:
+				for pointer in chart[(i, j)].get(label, ()):
+					if len(pointer) == 1:
+						result.append([(g.intern(pointer[0]), i, j)])
+					else:
+						(k, b, c) = pointer
+						result.append([(b, i, k), (c, k, j)])
+			return (label, i, j, result)
+
+		return expand
+
+
+class ViterbiParser(CYKParser):
+	"""
+	Viterbi CKY parser for a PSG with rule probabilities in Chomsky Normal
+	Form, run on its compiled form.
+
+	The chart is an array of shape (n + 1, n + 1, non-terminals) with the
+	log probability of the best analysis of every non-terminal over every
+	span (i, j), -inf for none. A cell is computed at once for all binary
+	rules and split points. The trees are extracted lazily from the chart
+	in the order of their probability (Huang and Chiang 2005, algorithm 3):
+	the k-th best tree costs only the work needed to get to it.
+
+	Beam pruning: with a threshold, the entries of a cell with less than
+	threshold times the probability of the best entry are dropped; with a
+	beam, only the beam best entries of a cell are kept.
+	"""
+
+	def __init__(self, grammar, start=None, threshold=None, beam=None):
+		CYKParser.__init__(self, grammar, start)
+		g = self.grammar
+		self.threshold = threshold
+		self.beam = beam
+
+		# the binary rules, sorted by left-hand-side like the rules of the
+		# compiled grammar, with their symbols and log probabilities
+		binary = [rule for rule in range(len(g)) if g.ruleLength(rule) == 2]
+		self.binary = np.array(binary, dtype=np.intp)
+		self.binaryLHS = np.array([g.ruleLHS[rule] for rule in binary], dtype=np.intp)
+		self.binaryB = np.array([g.rhs[g.rhsStart[rule]] for rule in binary], dtype=np.intp)
+		self.binaryC = np.array([g.rhs[g.rhsStart[rule] + 1] for rule in binary], dtype=np.intp)
+		self.binaryLogProb = np.array([g.logprob[rule] for rule in binary], dtype=np.float64)
+		(self.labels, self.labelStart) = np.unique(self.binaryLHS, return_index=True)
+		self.rulesByLHS = {}
+		for (label, first, last) in zip(self.labels, self.labelStart, list(self.labelStart[1:]) + [len(binary)]):
+			self.rulesByLHS[int(label)] = np.arange(first, last)
+
+	def _prune(self, cell):
+		"""Drop the entries of a chart cell that are out of the beam."""
+		if self.threshold is not None:
+			cell[cell < cell.max() + math.log(self.threshold)] = -np.inf
+		if self.beam is not None and self.beam < len(cell):
+			cell[cell < np.partition(cell, -self.beam)[-self.beam]] = -np.inf
+
+	def chart(self, tokens):
+		"""Run the parser over the list of tokens and return the chart of
+		log probabilities."""
+		g = self.grammar
+		tokens = tuple(tokens)
+		n = len(tokens)
+		chart = np.full((n + 1, n + 1, g.nonterminals), -np.inf)
+		for i in range(n):
+			for rule in g.getRulesByRHS((g.intern(tokens[i]),)):
+				chart[i, i + 1, g.ruleLHS[rule]] = g.logprob[rule]
+			self._prune(chart[i, i + 1])
+		if len(self.binary) == 0:
+			return chart
+		for length in range(2, n + 1):
+			for i in range(n - length + 1):
+				j = i + length
+				# the scores of every split point (rows) and binary rule
+				# (columns), the best split of every rule, and the best rule
+				# of every left-hand-side
+				scores = chart[i, i + 1:j][:, self.binaryB] + chart[i + 1:j, j][:, self.binaryC]
+				scores = scores.max(axis=0)
+				scores += self.binaryLogProb
+				chart[i, j, self.labels] = np.maximum.reduceat(scores, self.labelStart)
+				self._prune(chart[i, j])
+		return chart
+
+	def _expander(self, chart, tokens):
+		"""Return the function that expands the nodes (label, i, j) of the
+		forest of the analyses in the chart that are left after pruning."""
+		g = self.grammar
+
+		def expand(key):
+			(label, i, j) = key
+			result = []
+			if label >= g.nonterminals or chart[i, j, label] == -np.inf:
+				pass
+			elif j == i + 1:
+				result.append([(g.intern(tokens[i]), i, j)])
+			elif label in self.rulesByLHS:
+				rules = self.rulesByLHS[label]
+				scores = chart[i, i + 1:j][:, self.binaryB[rules]] + chart[i + 1:j, j][:, self.binaryC[rules]]
+				for (split, r) in zip(*np.nonzero(scores > -np.inf)):
+					k = i + 1 + int(split)
+					result.append([(int(self.binaryB[rules[r]]), i, k), (int(self.binaryC[rules[r]]), k, j)])
+			return (label, i, j, result)
+
+		return expand
+
+	def recognize(self, tokens):
+		"""Return True if the grammar accepts the list of tokens."""
+		tokens = tuple(tokens)
+		if not tokens:
+			return self.empty is not None
+		return self.start >= 0 and self.chart(tokens)[0, len(tokens), self.start] > -np.inf
+
+	def derivations(self, tokens):
+		"""Return a generator over the pairs (log probability, tree) of the
+		list of tokens, the most probable first."""
+		tokens = tuple(tokens)
+		if not tokens:
+			g = self.grammar
+			return iter([(g.logprob[self.empty], (g.symbols[self.start],))] if self.empty is not None else [])
+		if self.start < 0:
+			return iter(())
+		return self._derivations(tokens, self.chart(tokens))
+
+	def parse(self, tokens):
+		"""Return a generator over the parse trees of the list of tokens,
+		the most probable first."""
+		return (tree for (logprob, tree) in self.derivations(tokens))
+
+	def kbest(self, tokens, k):
+		"""Return the list of the k most probable pairs (log probability,
+		tree) of the list of tokens."""
+		result = []
+		for derivation in self.derivations(tokens):
+			result.append(derivation)
+			if len(result) >= k:
+				break
+		return result
+
+	def _derivations(self, tokens, chart):
+		"""Generate the pairs (log probability, tree) from the chart.
+
+		The derivations of a node (label, i, j) are tuples (log probability,
+		rule, split, ranks): the ranks are the positions of the derivations
+		of the two children in their own lists, the split is None for
+		lexical rules. found maps every node to the list of its derivations
+		found so far, best first, candidates to the heap of the next ones
+		and the set of the ones that were pushed."""
+		found = {}
+		candidates = {}
+		root = (self.start, 0, len(tokens))
+		if chart[0, len(tokens), self.start] == -np.inf:
+			return
+		k = 0
+		while True:
+			derivation = self._kth(chart, tokens, found, candidates, root, k)
+			if derivation is None:
+				return
+			yield (derivation[0], self._tree(chart, tokens, found, candidates, root, derivation))
+			k += 1
+
+	def _kth(self, chart, tokens, found, candidates, node, k):
+		"""Return the k-th best derivation of a node, or None."""
+		g = self.grammar
+		(label, i, j) = node
+		if node not in found:
+			found[node] = []
+			heap = []
+			pushed = set()
+			candidates[node] = (heap, pushed)
+			if j == i + 1:
+				for rule in g.getRulesByRHS((g.intern(tokens[i]),)):
+					if g.ruleLHS[rule] == label and chart[i, j, label] > -np.inf:
+						heap.append((-g.logprob[rule], rule, None, None))
+			elif label in self.rulesByLHS:
+				rules = self.rulesByLHS[label]
+				scores = chart[i, i + 1:j][:, self.binaryB[rules]] + chart[i + 1:j, j][:, self.binaryC[rules]] + self.binaryLogProb[rules]
+				for (split, r) in zip(*np.nonzero(scores > -np.inf)):
+					rule = int(self.binary[rules[r]])
+					heap.append((-float(scores[split, r]), rule, i + 1 + int(split), (0, 0)))
+					pushed.add((rule, i + 1 + int(split), (0, 0)))
+			heapq.heapify(heap)
+		derivations = found[node]
+		(heap, pushed) = candidates[node]
+		while len(derivations) <= k:
+			if derivations:
+				self._successors(chart, tokens, found, candidates, node, derivations[-1])
+			if not heap:
+				break
+			(score, rule, split, ranks) = heapq.heappop(heap)
+			derivations.append((-score, rule, split, ranks))
+		if k < len(derivations):
+			return derivations[k]
+		return None
+
+	def _successors(self, chart, tokens, found, candidates, node, derivation):
+		"""Push the derivations that follow a derivation of a node, with the
+		next derivation of one of the children, on the heap of the node."""
+		g = self.grammar
+		(score, rule, split, ranks) = derivation
+		if split is None:
+			return
+		(label, i, j) = node
+		(heap, pushed) = candidates[node]
+		b = g.rhs[g.rhsStart[rule]]
+		c = g.rhs[g.rhsStart[rule] + 1]
+		for following in ((ranks[0] + 1, ranks[1]), (ranks[0], ranks[1] + 1)):
+			if (rule, split, following) in pushed:
+				continue
+			pushed.add((rule, split, following))
+			left = self._kth(chart, tokens, found, candidates, (b, i, split), following[0])
+			right = self._kth(chart, tokens, found, candidates, (c, split, j), following[1])
+			if left is None or right is None:
+				continue
+			heapq.heappush(heap, (-(g.logprob[rule] + left[0] + right[0]), rule, split, following))
+
+	def _tree(self, chart, tokens, found, candidates, node, derivation):
+		"""Return the tree of a derivation of a node."""
+		g = self.grammar
+		(label, i, j) = node
+		(score, rule, split, ranks) = derivation
+		name = g.symbols[label]
+		if split is None:
+			return (name, tokens[i])
+		left = (g.rhs[g.rhsStart[rule]], i, split)
+		right = (g.rhs[g.rhsStart[rule] + 1], split, j)
+		return (name,
+			self._tree(chart, tokens, found, candidates, left, self._kth(chart, tokens, found, candidates, left, ranks[0])),
+			self._tree(chart, tokens, found, candidates, right, self._kth(chart, tokens, found, candidates, right, ranks[1])))
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+"""
+Filename: corpusparser.py
+
+Parse corpora with a grammar.PSG on a pool of processes.
+
+Every worker process loads the compiled grammar once, from the cache of
+the compiled form that the main process prepares (see
+grammar.CompiledPSG.load), and builds its own parser.
+The sentences are sent to the workers in chunks, with at most maxPending
+chunks in flight, such that a corpus of any size can be streamed through
+the pool with bounded memory. The results are returned in the order of
+the sentences, or as the chunks are done.
+
+The grammar file can be changed while the pool runs: reload() builds the
+new cache, and every chunk sent after it carries the new generation of
+the grammar, such that a worker loads the new grammar before it parses
+such a chunk. Chunks that are already in flight are not dropped, they
+are parsed with the grammar that their worker has at that time.
+
+Every sentence can have a timeout (on systems with signal.setitimer), a
+sentence that takes longer gets the error "timeout" and the worker goes
+on with the next one.
+
+This module has to be imported from a file, not defined in a notebook,
+for the worker processes to find it (see Parallelization_Example.ipynb).
+
+Example:
+
+	from corpusparser import CorpusParser
+
+	with CorpusParser("mygrammar.txt", parser="earley", analyze="count", timeout=2.0) as corpus:
+		for result in corpus.parse(open("corpus.txt")):
+			print(result.index, result.result, result.error)
+		print(corpus.stats)
+"""
+
+import itertools
+import multiprocessing as mp
+import signal
+import time
+from array import array
+from collections import namedtuple
+
+from grammar import CompiledPSG
+from chartparser import EarleyParser, CYKParser, ViterbiParser
+from poolstream import streamChunks
+
+
+PARSERS = {"earley": EarleyParser, "cyk": CYKParser, "viterbi": ViterbiParser}
+
+
+ParseResult = namedtuple("ParseResult", ["index", "tokens", "result", "error", "seconds"])
+ParseResult.__doc__ = """The result of a sentence: its index in the corpus, its tokens, the
+result of the analysis (None if there was an error), the error ("timeout"
+or the representation of the exception) and the parse time in seconds."""
+
+
+class SentenceTimeout(Exception):
+	"""Raised in a worker when a sentence takes longer than the timeout."""
+	pass
+
+
+def recognize(parser, tokens, limit):
+	"""Analysis: True if the grammar accepts the tokens."""
+	return parser.recognize(tokens)
+
+
+def count(parser, tokens, limit):
+	"""Analysis: the number of parse trees, from the parse forest."""
+	return parser.forest(tokens).count()
+
+
+def trees(parser, tokens, limit):
+	"""Analysis: the list of the first limit parse trees."""
+	return list(itertools.islice(parser.parse(tokens), limit))
+
+
+def best(parser, tokens, limit):
+	"""Analysis: the first parse tree, the most probable one for the
+	ViterbiParser, or None."""
+	return next(iter(parser.parse(tokens)), None)
+
+
+ANALYSES = {"recognize": recognize, "count": count, "trees": trees, "best": best}
+
+
+# the parser and settings of a worker process, set by _init
+_worker = {}
+
+
+def _alarm(signum, frame):
+	raise SentenceTimeout()
+
+
+def _init(filename, parser, options, cache, timeout, generation=0):
+	"""Initialize a worker process: load the compiled grammar once. An
+	error is kept and raised by the chunks, the pool would start new
+	workers over and over for an initializer that raises it."""
+	_worker["init"] = (filename, parser, options, cache, timeout)
+	_worker["generation"] = generation
+	_worker["error"] = None
+	try:
+		grammar = CompiledPSG.load(filename, cache=cache)
+		_worker["parser"] = PARSERS[parser](grammar, **options)
+	except Exception as e:
+		_worker["error"] = e
+		return
+	_worker["timeout"] = timeout if timeout and hasattr(signal, "setitimer") else None
+	if _worker["timeout"]:
+		signal.signal(signal.SIGALRM, _alarm)
+
+
+def _parse_chunk(task):
+	"""Parse a chunk of sentences in a worker process and return the chunk
+	number and the list of the ParseResults."""
+	(number, first, sentences, analyze, limit, generation) = task
+	if generation > _worker["generation"]:
+		# the grammar was reloaded, the new cache is ready
+		_init(*_worker["init"], generation=generation)
+	if _worker["error"] is not None:
+		raise _worker["error"]
+	parser = _worker["parser"]
+	timeout = _worker["timeout"]
+	if not callable(analyze):
+		analyze = ANALYSES[analyze]
+	results = []
+	for (offset, tokens) in enumerate(sentences):
+		started = time.time()
+		result = None
+		error = None
+		try:
+			if timeout:
+				signal.setitimer(signal.ITIMER_REAL, timeout)
+			try:
+				result = analyze(parser, tokens, limit)
+			finally:
+				if timeout:
+					signal.setitimer(signal.ITIMER_REAL, 0)
+		except SentenceTimeout:
+			error = "timeout"
+		except Exception as e:
+			error = repr(e)
+		results.append(ParseResult(first + offset, tokens, result, error, time.time() - started))
+	return (number, results)
+
+
+class CorpusParser:
+	"""
+	Parse corpora with a grammar file on a pool of worker processes.
+
+	parser: "earley", "cyk" or "viterbi", with the keyword arguments in
+	options (e.g. {"beam": 10} for the ViterbiParser).
+
+	analyze: what is computed for every sentence, "recognize", "count"
+	(the number of trees, from the parse forest), "trees" (the first limit
+	trees) or "best" (the first tree), or a module level function
+	analyze(parser, tokens, limit) that can be pickled.
+
+	chunkSize sentences are sent to a worker at once, at most maxPending
+	chunks (by default twice the number of processes) are in flight or
+	waiting to be returned in order. timeout is the maximal parse time of
+	a sentence in seconds. cache is the cache of the compiled grammar, see
+	grammar.CompiledPSG.load.
+
+	stats: dictionary with the statistics of the last call of parse():
+	sentences, chunks, errors, timeouts, seconds, sentences_per_sec, the
+	mean, median, 95th percentile and maximum parse time of a sentence
+	(latency_mean, latency_p50, latency_p95, latency_max), and the mean
+	and maximum time from sending a chunk to getting its results
+	(chunk_latency_mean, chunk_latency_max).
+	"""
+
+	def __init__(self, filename, parser="earley", options=None, analyze="count", limit=10,
+			processes=None, chunkSize=64, maxPending=None, timeout=None, cache=True):
+		if parser not in PARSERS:
+			raise ValueError("Unknown parser: " + str(parser))
+		if not callable(analyze) and analyze not in ANALYSES:
+			raise ValueError("Unknown analysis: " + str(analyze))
+		self.analyze = analyze
+		self.limit = limit
+		self.processes = processes or mp.cpu_count()
+		self.chunkSize = chunkSize
+		self.maxPending = maxPending or 2 * self.processes
+		self.stats = {}
+		self.filename = filename
+		self.cache = cache
+		self.generation = 0
+		# build the grammar cache once, before the workers read it
+		if cache:
+			CompiledPSG.load(filename, cache=cache)
+		self.pool = mp.Pool(self.processes, initializer=_init,
+			initargs=(filename, parser, options or {}, cache, timeout))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+		return False
+
+	def close(self):
+		"""Stop the worker processes."""
+		if self.pool is not None:
+			self.pool.terminate()
+			self.pool.join()
+			self.pool = None
+
+	def reload(self):
+		"""Reload the grammar file in the workers, for the chunks that are
+		sent from now on, and return the new generation of the grammar."""
+		if self.pool is None:
+			raise ValueError("CorpusParser is closed")
+		if self.cache:
+			CompiledPSG.load(self.filename, cache=self.cache)
+		self.generation += 1
+		return self.generation
+
+	def _chunks(self, sentences):
+		"""Generate the chunks (number, index of the first sentence, list of
+		token tuples) of the sentences, strings are split at white space."""
+		sentences = iter(sentences)
+		first = 0
+		for number in itertools.count():
+			chunk = [tuple(x.split()) if isinstance(x, str) else tuple(x)
+				for x in itertools.islice(sentences, self.chunkSize)]
+			if not chunk:
+				return
+			yield (number, first, chunk)
+			first += len(chunk)
+
+	def parse(self, sentences, ordered=True):
+		"""Return a generator over the ParseResults of the sentences, an
+		iterable over token lists or strings, in the order of the sentences
+		or, with ordered=False, as they are done."""
+		if self.pool is None:
+			raise ValueError("CorpusParser is closed")
+		return self._parse(sentences, ordered)
+
+	def _parse(self, sentences, ordered):
+		tasks = ((number, first, tokens, self.analyze, self.limit, self.generation)
+			for (number, first, tokens) in self._chunks(sentences))
+		latencies = array("d")
+		chunkLatencies = array("d")
+		stats = self.stats = {"sentences": 0, "chunks": 0, "errors": 0, "timeouts": 0}
+		started = time.time()
+		try:
+			for ((number, results), seconds) in streamChunks(self.pool, _parse_chunk, tasks, self.maxPending, ordered):
+				chunkLatencies.append(seconds)
+				stats["chunks"] += 1
+				for result in results:
+					stats["sentences"] += 1
+					if result.error is not None:
+						stats["errors"] += 1
+						if result.error == "timeout":
+							stats["timeouts"] += 1
+					latencies.append(result.seconds)
+					yield result
+		finally:
+			self._statistics(stats, started, latencies, chunkLatencies)
+
+	def _statistics(self, stats, started, latencies, chunkLatencies):
+		"""Add the throughput and latency statistics to stats."""
+		stats["seconds"] = time.time() - started
+		stats["sentences_per_sec"] = stats["sentences"] / stats["seconds"] if stats["seconds"] > 0 else 0.0
+		ordered = sorted(latencies)
+		if ordered:
+			stats["latency_mean"] = sum(ordered) / len(ordered)
+			stats["latency_p50"] = ordered[len(ordered) // 2]
+			stats["latency_p95"] = ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))]
+			stats["latency_max"] = ordered[-1]
+		if chunkLatencies:
+			stats["chunk_latency_mean"] = sum(chunkLatencies) / len(chunkLatencies)
+			stats["chunk_latency_max"] = max(chunkLatencies)
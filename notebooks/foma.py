@@ -18,6 +18,9 @@
 #   limitations under the License.                                            #
 
 from sys import maxsize # maxint
+from collections import OrderedDict
+from threading import Lock, RLock, local
+import weakref
 from ctypes import *
 from ctypes.util import find_library
 
@@ -107,22 +110,139 @@ class FSTfunctiondefinitions(object):
 
     def __init__(self):
         self.deffhandle = defined_functions_init(None)
-        
-                
+
+
+class FSTcache(object):
+    """Bounded memoization of lookups, keyed by (direction, word, tokenize).
+       Evicts the least recently used entries when there are more than
+       maxsize entries, or the outputs take more than maxbytes characters
+       (if given). A lock makes it safe to share between threads."""
+
+    def __init__(self, maxsize = 65536, maxbytes = None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _size(key, outputs):
+        return len(key[1]) + sum(len(x) if not isinstance(x, list) else sum(len(y) for y in x) for x in outputs)
+
+    def get(self, key):
+        """Returns the outputs of a key, or None."""
+        with self.lock:
+            outputs = self.entries.get(key)
+            if outputs is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return outputs
+
+    def put(self, key, outputs):
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = outputs
+            self.size += self._size(key, outputs)
+            while self.entries and (len(self.entries) > self.maxsize or (self.maxbytes is not None and self.size > self.maxbytes)):
+                (oldkey, oldoutputs) = self.entries.popitem(last = False)
+                self.size -= self._size(oldkey, oldoutputs)
+                self.evictions += 1
+
+    def clear(self):
+        """Drops all entries, e.g. when the network changed."""
+        with self.lock:
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """Returns the counters as a dictionary."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hitrate': float(self.hits) / lookups if lookups else 0.0,
+                    'evictions': self.evictions, 'invalidations': self.invalidations, 'entries': len(self.entries),
+                    'bytes': self.size, 'maxsize': self.maxsize, 'maxbytes': self.maxbytes}
+
+
+def _handleaddress(handle):
+    return cast(handle, c_void_p).value if handle else None
+
+
+# debug counters of the native handles held by FST objects and appliers
+_livehandles = {'fsm': 0, 'applyer': 0}
+_livelock = Lock()
+
+def _countlive(kind, change):
+    with _livelock:
+        _livehandles[kind] += change
+
+def livehandles():
+    """Returns the numbers of the networks held by FST objects and of the
+       appliers that are not cleared yet; they should stay flat under
+       sustained load."""
+    with _livelock:
+        return dict(_livehandles)
+
+def _applyinit(fsthandle):
+    applyerhandle = foma_apply_init(fsthandle)
+    _countlive('applyer', 1)
+    return applyerhandle
+
+def _applyclear(applyerhandle):
+    foma_apply_clear(c_void_p(applyerhandle))
+    _countlive('applyer', -1)
+
+class _ThreadApplyers(dict):
+    """The appliers of one thread by tokenize, in the thread-local data of
+       an FST; handles is the list of their handles, which outlives the
+       dictionary."""
+    def __init__(self):
+        dict.__init__(self)
+        self.handles = []
+
+def _clearthread(lock, live, handles):
+    # the thread-local data of a thread was collected (the thread ended):
+    # clear its appliers, unless _clearapplyers did already
+    with lock:
+        for applyerhandle in handles:
+            try:
+                live.remove(applyerhandle)
+            except KeyError:
+                continue
+            _applyclear(applyerhandle)
+
+
 class FST(object):
 
     networkdefinitions = FSTnetworkdefinitions()
     functiondefinitions = FSTfunctiondefinitions()
+    _fsthandle = None
+    getitemapplyer = None
+    tokenizeapplyer = None
+    cache = None
+    threadlocal = None
+    # regex compilation goes through the shared definitions
+    definitionlock = Lock()
 
     @classmethod
     def define(cls, definition, name):
         """Defines an FSM constant; can be supplied regex or existing FSM."""
         name = cls.encode(name)
         if isinstance(definition, FST):
-            retval = foma.add_defined(c_void_p(cls.networkdefinitions.defhandle), foma_fsm_copy(definition.fsthandle), c_char_p(name))
+            with cls.definitionlock:
+                retval = foma.add_defined(c_void_p(cls.networkdefinitions.defhandle), foma_fsm_copy(definition.fsthandle), c_char_p(name))
         elif isinstance(definition, basestring):
             regex = cls.encode(definition)
-            retval = foma.add_defined(c_void_p(cls.networkdefinitions.defhandle), foma_fsm_parse_regex(c_char_p(regex), c_void_p(cls.networkdefinitions.defhandle), c_void_p(cls.functiondefinitions.deffhandle)), c_char_p(name))
+            with cls.definitionlock:
+                retval = foma.add_defined(c_void_p(cls.networkdefinitions.defhandle), foma_fsm_parse_regex(c_char_p(regex), c_void_p(cls.networkdefinitions.defhandle), c_void_p(cls.functiondefinitions.deffhandle)), c_char_p(name))
         else:
             raise ValueError("Expected str, unicode, or FSM")
 
@@ -137,7 +257,8 @@ class FST(object):
             for i in xrange(numargs):
                 definition = definition.replace(prototype[1][i], "@ARGUMENT0%i@" % (i+1))
             regex = cls.encode(definition + ';')
-            retval = foma.add_defined_function(c_void_p(cls.functiondefinitions.deffhandle), c_char_p(name), c_char_p(regex), c_int(numargs))
+            with cls.definitionlock:
+                retval = foma.add_defined_function(c_void_p(cls.functiondefinitions.deffhandle), c_char_p(name), c_char_p(regex), c_int(numargs))
         else:
             raise ValueError("Expected regex as definition")
          
@@ -178,30 +299,158 @@ class FST(object):
     def __init__(self, regex = False):
         if regex:
             self.regex = self.encode(regex)
-            self.fsthandle = foma_fsm_parse_regex(c_char_p(self.regex), c_void_p(self.networkdefinitions.defhandle), c_void_p(self.functiondefinitions.deffhandle))
+            with self.definitionlock:
+                self.fsthandle = foma_fsm_parse_regex(c_char_p(self.regex), c_void_p(self.networkdefinitions.defhandle), c_void_p(self.functiondefinitions.deffhandle))
             if not self.fsthandle:
                 raise ValueError("Syntax error in regex")
         else:
             self.fsthandle = None
-        self.getitemapplyer = None
+
+    @property
+    def fsthandle(self):
+        return self._fsthandle
+
+    @fsthandle.setter
+    def fsthandle(self, handle):
+        # the appliers and the cache belong to the old network
+        if _handleaddress(self._fsthandle) != _handleaddress(handle):
+            self._clearapplyers()
+            if self.cache is not None:
+                self.cache.clear()
+            _countlive('fsm', bool(handle) - bool(self._fsthandle))
+        self._fsthandle = handle
+
+    def close(self):
+        """Frees the network and the appliers at once, instead of when the
+           object is collected. The FST is undefined afterwards."""
+        self._clearapplyers()
+        handle = self.fsthandle
+        if handle:
+            self.fsthandle = None
+            foma_fsm_destroy(handle)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def setcache(self, maxsize = 65536, maxbytes = None):
+        """Memoizes apply_down, apply_up and __getitem__ in an FSTcache,
+           and returns it; maxsize None switches the cache off."""
+        self.cache = FSTcache(maxsize, maxbytes) if maxsize is not None else None
+        return self.cache
 
     def __getitem__(self, key):
         if not self.fsthandle:
             raise KeyError('FST not defined')
+        return list(self._cached(foma_apply_down, key))
+
+    def _cached(self, applyf, word, tokenize = False):
+        """Returns the list of all outputs for one word, from the cache if
+           there is one; the list in the cache must not be changed."""
+        cache = self.cache
+        if cache is None:
+            return self._lookup(applyf, word, tokenize)
+        key = ('down' if applyf is foma_apply_down else 'up', word, tokenize)
+        outputs = cache.get(key)
+        if outputs is None:
+            outputs = self._lookup(applyf, word, tokenize)
+            cache.put(key, outputs)
+        return outputs
+
+    def _lookup(self, applyf, word, tokenize = False):
+        """Returns the list of all outputs for one word from the appliers of
+           the FST. The shared appliers are used by one thread at a time,
+           the appliers of a thread (setthreadsafe) without a lock."""
+        if self.threadlocal is not None:
+            return self._applyword(applyf, self._applyer(tokenize), word, tokenize)
+        lock = self.__dict__.get('applylock')
+        if lock is None:
+            # setdefault is atomic, all threads get the same lock
+            lock = self.__dict__.setdefault('applylock', Lock())
+        with lock:
+            return self._applyword(applyf, self._applyer(tokenize), word, tokenize)
+
+    def setthreadsafe(self, threadsafe = True):
+        """Gives every thread its own appliers over the shared network, for
+           lookups from several threads without locks. The appliers of a
+           thread are cleared when it ends, the others with close(). The
+           network must not be changed while other threads use it."""
+        self._clearapplyers()
+        if threadsafe:
+            self.threadlocal = local()
+            self.threadapplyers = set()
+            # reentrant, as the thread-local data of the threads can be
+            # collected (and their appliers cleared) while it is held
+            self.threadlock = RLock()
+        else:
+            self.threadlocal = None
+
+    def _newapplyer(self, tokenize = False):
+        applyerhandle = _applyinit(self.fsthandle)
+        if tokenize:
+            foma_apply_set_space_symbol(c_void_p(applyerhandle), c_char_p('\x07'))
+        return applyerhandle
+
+    def _applyer(self, tokenize = False):
+        """Returns the applier of the FST, initialized once and kept until
+        the FST is deleted; with tokenize, a second one with the space
+        symbol set. In thread safe mode, the appliers of the thread."""
+        if self.threadlocal is not None:
+            applyers = getattr(self.threadlocal, 'applyers', None)
+            if applyers is None:
+                applyers = self.threadlocal.applyers = _ThreadApplyers()
+                # the finalizer must not refer to the FST, which would stay
+                # alive as long as the thread
+                finalizer = weakref.finalize(applyers, _clearthread, self.threadlock, self.threadapplyers, applyers.handles)
+                finalizer.atexit = False
+            applyerhandle = applyers.get(tokenize)
+            if applyerhandle is None:
+                # only the first lookups of a thread take the lock
+                with self.threadlock:
+                    applyerhandle = applyers[tokenize] = self._newapplyer(tokenize)
+                    applyers.handles.append(applyerhandle)
+                    self.threadapplyers.add(applyerhandle)
+            return applyerhandle
+        if tokenize:
+            if not self.tokenizeapplyer:
+                self.tokenizeapplyer = self._newapplyer(True)
+            return self.tokenizeapplyer
         if not self.getitemapplyer:
-            self.getitemapplyer = foma_apply_init(self.fsthandle)
+            self.getitemapplyer = self._newapplyer()
+        return self.getitemapplyer
+
+    def _applyword(self, applyf, applyerhandle, word, tokenize = False):
+        """Returns the list of all outputs for one word, such that the
+        applier is free again when it returns."""
         result = []
-        output = foma_apply_down(c_void_p(self.getitemapplyer), c_char_p(self.encode(key)))
-        while True:
-            if output == None:
-                return result
+        output = applyf(c_void_p(applyerhandle), c_char_p(self.encode(word)))
+        while output != None:
+            if tokenize:
+                result.append(output[:-1].split('\x07'))
             else:
                 result.append(output)
-                output = foma_apply_down(c_void_p(self.getitemapplyer), None)
-            
+            output = applyf(c_void_p(applyerhandle), None)
+        return result
+
+    def _clearapplyers(self):
+        for name in ('getitemapplyer', 'tokenizeapplyer'):
+            if getattr(self, name, None):
+                _applyclear(getattr(self, name))
+                setattr(self, name, None)
+        if self.threadlocal is not None:
+            with self.threadlock:
+                # an applier is taken out of the set before it is cleared,
+                # such that the finalizer of its thread skips it
+                while self.threadapplyers:
+                    _applyclear(self.threadapplyers.pop())
+                # the threads make new appliers with the next lookup
+                self.threadlocal = local()
+
     def __del__(self):
-        if self.fsthandle:
-            foma_fsm_destroy(self.fsthandle)
+        self.close()
 
     def __str__(self):
         if not self.fsthandle:
@@ -236,13 +485,19 @@ class FST(object):
     
     def __le__(self, other):
         if self.fsthandle and other.fsthandle:
-            return bool(c_int(foma_fsm_isempty(foma_fsm_minimize(foma_fsm_minus(foma_fsm_copy(self.fsthandle),foma_fsm_copy(other.fsthandle))))))
+            # fsm_minus consumes the copies, fsm_isempty does not take the
+            # difference
+            difference = foma_fsm_minimize(foma_fsm_minus(foma_fsm_copy(self.fsthandle),foma_fsm_copy(other.fsthandle)))
+            try:
+                return bool(c_int(foma_fsm_isempty(difference)))
+            finally:
+                foma_fsm_destroy(difference)
         else:
             raise ValueError('Undefined FST')
 
     def __lt__(self, other):
         if self.fsthandle and other.fsthandle:
-            return (not self.__eq__(other)) and bool(c_int(foma_fsm_isempty(foma_fsm_minimize(foma_fsm_minus(foma_fsm_copy(self.fsthandle),foma_fsm_copy(other.fsthandle))))))
+            return (not self.__eq__(other)) and self.__le__(other)
         else:
             raise ValueError('Undefined FST')        
         
@@ -254,6 +509,7 @@ class FST(object):
 
     def __eq__(self, other):
         if self.fsthandle and other.fsthandle:
+            # fsm_equivalent destroys both of the copies
             return bool(c_int(foma_fsm_equivalent(foma_fsm_copy(self.fsthandle), foma_fsm_copy(other.fsthandle))))
         else:
             raise ValueError('Undefined FST')
@@ -264,10 +520,14 @@ class FST(object):
     def __contains__(self, word):
         af = self.apply_down(word)
         try:
-            i = af.next()
+            next(af)
             return True
         except StopIteration:
             return False
+        finally:
+            # clears the applier of the abandoned generator now
+            if hasattr(af, 'close'):
+                af.close()
                 
     def __call__(self, other):
         if isinstance(other, basestring):
@@ -286,27 +546,30 @@ class FST(object):
     def _apply(self, applyf, word = None, tokenize = False):
         if not self.fsthandle:
             raise ValueError('FST not defined')
-        applyerhandle = foma_apply_init(self.fsthandle)
-        if tokenize:
-            toksym = '\x07'
-            foma_apply_set_space_symbol(c_void_p(applyerhandle), c_char_p(toksym))
-        if word:
-            output = applyf(c_void_p(applyerhandle), c_char_p(self.encode(word)))
-        else:
-            output = applyf(c_void_p(applyerhandle))
-        while True:
-            if output == None:
-                foma_apply_clear(c_void_p(applyerhandle))
-                return
-            else:
-                if tokenize:
-                    yield output[:-1].split('\x07')
-                else:
-                    yield output
+        applyerhandle = _applyinit(self.fsthandle)
+        # the applier is cleared also when the generator is abandoned
+        try:
+            if tokenize:
+                toksym = '\x07'
+                foma_apply_set_space_symbol(c_void_p(applyerhandle), c_char_p(toksym))
             if word:
-                output = applyf(c_void_p(applyerhandle), None)
+                output = applyf(c_void_p(applyerhandle), c_char_p(self.encode(word)))
             else:
                 output = applyf(c_void_p(applyerhandle))
+            while True:
+                if output == None:
+                    return
+                else:
+                    if tokenize:
+                        yield output[:-1].split('\x07')
+                    else:
+                        yield output
+                if word:
+                    output = applyf(c_void_p(applyerhandle), None)
+                else:
+                    output = applyf(c_void_p(applyerhandle))
+        finally:
+            _applyclear(applyerhandle)
                     
     def words(self, tokenize = False):
         return self._apply(foma_apply_words, word = None, tokenize = tokenize)
@@ -318,14 +581,47 @@ class FST(object):
         return self._apply(foma_apply_upper_words, word = None, tokenize = tokenize)
         
     def apply_down(self, word, tokenize = False):
+        if (self.cache is not None or self.threadlocal is not None) and word and self.fsthandle:
+            return iter(self._cached(foma_apply_down, word, tokenize))
         return self._apply(foma_apply_down, word = word, tokenize = tokenize)
 
     def apply_up(self, word, tokenize = False):
         if self.fsthandle:
+            if (self.cache is not None or self.threadlocal is not None) and word:
+                return iter(self._cached(foma_apply_up, word, tokenize))
             return self._apply(foma_apply_up, word = word, tokenize = tokenize)
         else:
             raise ValueError('Undefined FST')
 
+    def apply_down_batch(self, words, tokenize = False):
+        """Applies down every word of an iterable, and yields the pairs
+        (word, list of outputs). All words go through the one applier of
+        the FST, which is not initialized again for every word, or the
+        cache, if there is one."""
+        return self._applybatch(foma_apply_down, words, tokenize)
+
+    def apply_up_batch(self, words, tokenize = False):
+        """Applies up every word of an iterable, and yields the pairs
+        (word, list of outputs), as apply_down_batch."""
+        return self._applybatch(foma_apply_up, words, tokenize)
+
+    def _applybatch(self, applyf, words, tokenize = False):
+        # the network is checked here, before the generator starts
+        if not self.fsthandle:
+            raise ValueError('FST not defined')
+        return self._batch(applyf, words, tokenize)
+
+    def _batch(self, applyf, words, tokenize):
+        for word in words:
+            # the applier is looked up for every word, as close(), a new
+            # fsthandle or setthreadsafe() between two words clear it,
+            # and the generator can be resumed from another thread; all
+            # outputs of a word are read before the pair is yielded, such
+            # that other calls can use the applier in between
+            if not self.fsthandle:
+                raise ValueError('FST not defined')
+            yield (word, list(self._cached(applyf, word, tokenize)))
+
     def _fomacallunary(self, func, minimize = True):
         if self.fsthandle:
             handle = func(foma_fsm_copy(self.fsthandle))
@@ -381,8 +677,8 @@ class FST(object):
 
     def flatten(self):
         new = FST()
-        eps_sym = FST('□')
-        new.fsthandle = foma_fsm_flatten(foma_fsm_copy(self.fsthandle), foma_fsm_copy(eps_sym.fsthandle))
+        with FST('□') as eps_sym:
+            new.fsthandle = foma_fsm_flatten(foma_fsm_copy(self.fsthandle), foma_fsm_copy(eps_sym.fsthandle))
         return new
     
 class MTFSM(FST):
@@ -390,8 +686,10 @@ class MTFSM(FST):
     def __init__(self, regex = False, numtapes = 2):
         if isinstance(regex, str) or isinstance(regex, unicode):
             FST.__init__(self, regex)
-            eps_sym = FST('□')
-            self.fsthandle = foma_fsm_flatten(foma_fsm_copy(self.fsthandle), foma_fsm_copy(eps_sym.fsthandle))
+            parsed = self.fsthandle
+            with FST('□') as eps_sym:
+                self.fsthandle = foma_fsm_flatten(foma_fsm_copy(parsed), foma_fsm_copy(eps_sym.fsthandle))
+            foma_fsm_destroy(parsed)
             self.numtapes = numtapes
         elif isinstance(regex, FST):
             self.fsthandle = foma_fsm_copy(regex.fsthandle)
@@ -447,18 +745,20 @@ class MTFSM(FST):
     def _apply(self, applyf, word = None):
         if not self.fsthandle:
             raise ValueError('FST not defined')
-        applyerhandle = foma_apply_init(self.fsthandle)
-        output = applyf(c_void_p(applyerhandle))
-        while True:
-            if output == None:
-                foma_apply_clear(c_void_p(applyerhandle))
-                return
-            else:
-                yield output
-            if word:
-                output = applyf(c_void_p(applyerhandle), None)
-            else:
-                output = applyf(c_void_p(applyerhandle))
+        applyerhandle = _applyinit(self.fsthandle)
+        try:
+            output = applyf(c_void_p(applyerhandle))
+            while True:
+                if output == None:
+                    return
+                else:
+                    yield output
+                if word:
+                    output = applyf(c_void_p(applyerhandle), None)
+                else:
+                    output = applyf(c_void_p(applyerhandle))
+        finally:
+            _applyclear(applyerhandle)
 
     def __iter__(self):
         return self._mtwords()
@@ -483,14 +783,16 @@ class MTFSM(FST):
         applyf = foma_apply_upper_words
         if not self.fsthandle:
             raise ValueError('FST not defined')
-        applyerhandle = foma_apply_init(self.fsthandle)
-        toksym = '\x07'
-        foma_apply_set_space_symbol(c_void_p(applyerhandle), c_char_p(toksym))
-        output = applyf(c_void_p(applyerhandle))
-        while True:
-            if output == None:
-                foma_apply_clear(c_void_p(applyerhandle))
-                return
-            else:
-                yield self._fmt(output[:-1].split('\x07'))
+        applyerhandle = _applyinit(self.fsthandle)
+        try:
+            toksym = '\x07'
+            foma_apply_set_space_symbol(c_void_p(applyerhandle), c_char_p(toksym))
             output = applyf(c_void_p(applyerhandle))
+            while True:
+                if output == None:
+                    return
+                else:
+                    yield self._fmt(output[:-1].split('\x07'))
+                output = applyf(c_void_p(applyerhandle))
+        finally:
+            _applyclear(applyerhandle)
@@ -39,9 +39,87 @@ V -> chase
 V -> ignore
 
 ------------  end file example  ------------
+
+Rules can have a probability in square brackets at the end, as in the
+PCFG format of NLTK:
+
+S -> NP VP [1.0]
+NP -> Art N [0.7]
+NP -> N [0.3]
+
+Rules without a probability share the probability mass that the rules
+with the same left-hand-side leave, i.e. the rules of a left-hand-side
+without any probabilities are equally likely.
 """
 
+import gc
+import hashlib
+import marshal
+import math
+import os
+import struct
 import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+
+cacheMagic = b"PSGCACHE"
+cacheHeader = struct.Struct("<8sIdQ20sI")
+
+
+def fileHash(filename):
+	"""Return the SHA-1 digest of a file."""
+	digest = hashlib.sha1()
+	with open(filename, "rb") as file:
+		for block in iter(lambda: file.read(1 << 20), b""):
+			digest.update(block)
+	return digest.digest()
+
+
+def readCache(filename, cache, version):
+	"""Return the data in the cache file for the file filename, or None if
+	there is no cache file or it is not valid for the file, i.e. for
+	another version of the format, the file size, or the modification time
+	and the SHA-1 hash. The cache is loaded with a single read."""
+	info = os.stat(filename)
+	try:
+		with open(cache, "rb") as file:
+			data = file.read()
+	except (IOError, OSError):
+		return None
+	if len(data) < cacheHeader.size:
+		return None
+	(magic, cached, mtime, size, digest, python) = cacheHeader.unpack_from(data)
+	if magic != cacheMagic or cached != version or python != sys.hexversion >> 16:
+		return None
+	if size != info.st_size:
+		return None
+	if mtime != info.st_mtime and digest != fileHash(filename):
+		return None
+	try:
+		return marshal.loads(data[cacheHeader.size:])
+	except (EOFError, ValueError, TypeError):
+		return None
+
+
+def writeCache(filename, cache, version, data):
+	"""Store the data (marshal-able) in the cache file for the file
+	filename, through a temporary file that is renamed. Raises IOError or
+	OSError on failures."""
+	info = os.stat(filename)
+	header = cacheHeader.pack(cacheMagic, version, info.st_mtime, info.st_size, fileHash(filename), sys.hexversion >> 16)
+	temporary = cache + "." + str(os.getpid())
+	try:
+		with open(temporary, "wb") as file:
+			file.write(header)
+			file.write(marshal.dumps(data))
+		os.rename(temporary, cache)
+	finally:
+		if os.path.exists(temporary):
+			os.remove(temporary)
+
 
 class PSG:
 	"""
@@ -53,13 +131,107 @@ class PSG:
 	
 	RHS: dictionary with right-hand-side symbol tuples as keys and a list
 	of possible left-hand-sides.
+	
+	Indexes for parsers:
+	
+	FIRST: dictionary with symbols as keys and a list of the rules
+	(lhs, rhs) with the symbol as the first right-hand-side symbol.
+	
+	NULLABLE: set of the symbols that derive the empty string.
+	
+	LC: dictionary with left-hand-side symbols as keys and the set of
+	their left corners as values, i.e. all the symbols (terminals and
+	non-terminals) that a derivation from the symbol can start with.
+	
+	start: the start symbol, the left-hand-side of the first rule.
+	
+	filename: the grammar file, None for grammars made from rules.
+	
+	version: the number of changes by addRule() and removeRule().
+	
+	RULES: set of the rules (lhs, rhs), to skip duplicates.
+	
+	WEIGHTS: dictionary with the rules (lhs, rhs) as keys and the
+	probabilities given in the grammar file as values.
+	
+	PROB: dictionary with the rules (lhs, rhs) as keys and their
+	probabilities as values, with the defaults for the rules without one.
+	
+	stats: dictionary with load statistics: source ("file" or "cache"),
+	lines, rules, duplicates, skipped (lines that are not rules), seconds
+	and the cache file name, if any.
+	
+	Symbols that are not a left-hand-side are terminals.
+	
+	With cache=True (or a file name) the grammar and its indexes are
+	stored in a binary cache file next to the grammar file, by default
+	the grammar file name with ".cache" appended. The cache is used as long
+	as the modification time of the grammar file is the same, or its SHA-1
+	hash is, and it is loaded with a single read.
+	
+	Without a file name the grammar is empty, PSG.fromRules() makes a
+	grammar from a list of rules.
 	"""
 
-	def __init__(self, filename):
+	cacheVersion = 2
+
+	def __init__(self, filename=None, cache=False):
 		"""Constructor."""
+		self.filename = filename
+		self.version = 0
 		self.LHS   = {}
 		self.RHS   = {}
-		self.__read__(filename)
+		self.FIRST = {}
+		self.NULLABLE = set()
+		self.LC    = {}
+		self.start = None
+		self.RULES = set()
+		self.WEIGHTS = {}
+		self.PROB  = {}
+		self.stats = {"source": "file", "lines": 0, "rules": 0, "duplicates": 0, "skipped": 0, "seconds": 0.0, "cache": None}
+		if filename is None:
+			self.stats["source"] = "rules"
+			return
+		started = time.time()
+		if cache is True:
+			cache = filename + ".cache"
+		self.stats["cache"] = cache or None
+		# the loader only creates containers without reference cycles, the
+		# garbage collector would just rescan them over and over
+		collecting = gc.isenabled()
+		gc.disable()
+		try:
+			data = readCache(filename, cache, self.cacheVersion) if cache else None
+			if data is not None:
+				self.__loadstate__(data)
+				self.stats["source"] = "cache"
+			else:
+				self.__read__(filename)
+				self.__makeindexes__()
+				if cache:
+					try:
+						writeCache(filename, cache, self.cacheVersion, self.__state__())
+					except (IOError, OSError) as e:
+						self.stats["cacheError"] = str(e)
+		finally:
+			if collecting:
+				gc.enable()
+		self.stats["rules"] = len(self.RULES)
+		self.stats["seconds"] = time.time() - started
+
+	@classmethod
+	def fromRules(cls, rules, start=None):
+		"""Make a grammar from a list of rules (lhs, rhs) or (lhs, rhs,
+		probability), with rhs a tuple of symbols. The start symbol is the
+		left-hand-side of the first rule by default."""
+		grammar = cls()
+		for rule in rules:
+			grammar.__addrule__(*rule)
+		if start is not None:
+			grammar.start = start
+		grammar.__makeindexes__()
+		grammar.stats["rules"] = len(grammar.RULES)
+		return grammar
 
 	def __str__(self):
 		"""Generates a string representation of the grammar such that the grammar
@@ -69,31 +241,223 @@ class PSG:
 			if len(text) > 0:
 				text += "\n"
 			for x in self.LHS[i]:
-				text += i + " -> " + " ".join(x) + "\n"
+				text += i + " -> " + " ".join(x)
+				if self.WEIGHTS:
+					text += " [" + repr(self.PROB[(i, x)]) + "]"
+				text += "\n"
 		return text
 
 	def __read__(self, filename):
-		"""Read in a CFG and return a grammar representation. This is a
+		"""Read in a CFG and return a grammar representation. The file is
+		read line by line; an IOError is raised if it cannot be read. This
+		is a hidden method."""
+		stats = self.stats
+		with open(filename) as file:
+			for i in file:
+				stats["lines"] += 1
+				i = i.partition("#")[0] # cut off comment string
+				(left, arrow, right) = i.partition("->")
+				if not arrow:   # rule line, expected -> somewhere
+					if i.strip():
+						stats["skipped"] += 1
+					continue
+				lhs = left.split()
+				if len(lhs) != 1 or "->" in right: # exactly one LHS token and one ->
+					stats["skipped"] += 1
+					continue
+				lhs = lhs[0]
+				rhs = right.split()
+				probability = None
+				if rhs and rhs[-1][:1] == "[" and rhs[-1][-1:] == "]":
+					try:
+						probability = float(rhs[-1][1:-1])
+					except ValueError:
+						pass
+					if probability is None or not 0.0 <= probability <= 1.0:
+						stats["skipped"] += 1
+						continue
+					rhs.pop()
+				if not self.__addrule__(lhs, tuple(rhs), probability):
+					stats["duplicates"] += 1
+
+	def __addrule__(self, lhs, rhs, probability=None):
+		"""Add the rule lhs -> rhs, without updating the indexes. Return
+		False if it is a duplicate. This is a hidden method."""
+		if (lhs, rhs) in self.RULES:
+			return False
+		if self.start is None:
+			self.start = lhs
+		self.RULES.add((lhs, rhs))
+		if probability is not None:
+			self.WEIGHTS[(lhs, rhs)] = probability
+		self.LHS.setdefault(lhs, []).append(rhs)
+		self.RHS.setdefault(rhs, []).append(lhs)
+		return True
+
+	def __state__(self):
+		"""Return the rules and indexes as a tuple for the cache. This is a
 		hidden method."""
-		try:
-			file = open(filename)
-			for i in file.readlines():
-				i = i.split("#")[0].strip() # cut off comment string and strip
-				if len(i) > 0:   # rule line, expected -> somewhere
-					tokens = i.split("->")
-					if len(tokens) == 2: # we need exactly two tokens
-						lhs = tokens[0].split()
-						if len(lhs) == 1: # we need exactly one token on LHS
-							rhs = tuple(tokens[1].split())
-							value = self.LHS.get(lhs[0], [ ])
-							if rhs not in value:  value.append(rhs)
-							self.LHS[lhs[0]] = value
-							value = self.RHS.get(rhs, [ ])
-							if lhs[0] not in value:  value.append(lhs[0])
-							self.RHS[rhs] = value
-			file.close()
-		except IOError:
-			pass
+		return (self.start, self.LHS, self.RHS, self.FIRST, self.NULLABLE, self.LC, self.RULES, self.WEIGHTS, self.PROB)
+
+	def __loadstate__(self, state):
+		"""Set the rules and indexes from a tuple of __state__(). This is a
+		hidden method."""
+		(self.start, self.LHS, self.RHS, self.FIRST, self.NULLABLE, self.LC, self.RULES, self.WEIGHTS, self.PROB) = state
+
+	def __makeindexes__(self):
+		"""Build the indexes FIRST, NULLABLE and LC and the rule
+		probabilities PROB from the rules. This is a hidden method."""
+		self.PROB = {}
+		for lhs in self.LHS:
+			self.__normalize__(lhs)
+
+		self.FIRST = {}
+		for lhs in self.LHS:
+			for rhs in self.LHS[lhs]:
+				if len(rhs) > 0:
+					self.FIRST.setdefault(rhs[0], []).append((lhs, rhs))
+
+		self.NULLABLE = self.__nullable__()
+		self.LC = self.__leftcorners__(self.LHS)
+
+	def __normalize__(self, lhs):
+		"""Set the probabilities PROB of the rules of lhs. This is a hidden
+		method."""
+		given = [self.WEIGHTS[(lhs, rhs)] for rhs in self.LHS[lhs] if (lhs, rhs) in self.WEIGHTS]
+		missing = len(self.LHS[lhs]) - len(given)
+		share = max(1.0 - sum(given), 0.0) / missing if missing else 0.0
+		for rhs in self.LHS[lhs]:
+			self.PROB[(lhs, rhs)] = self.WEIGHTS.get((lhs, rhs), share)
+
+	def __nullable__(self):
+		"""Return the set of the nullable symbols. This is a hidden method."""
+		# a symbol is nullable if it has a rule with only nullable symbols
+		# (or none) on the right-hand-side; repeat until nothing changes
+		nullable = set()
+		changed = True
+		while changed:
+			changed = False
+			for lhs in self.LHS:
+				if lhs in nullable:
+					continue
+				for rhs in self.LHS[lhs]:
+					if all(x in nullable for x in rhs):
+						nullable.add(lhs)
+						changed = True
+						break
+		return nullable
+
+	def __leftcorners__(self, symbols):
+		"""Return a dictionary with the sets of the left corners of the
+		symbols, by NULLABLE. This is a hidden method."""
+		# the direct left corners of a symbol are the first symbols of its
+		# right-hand-sides, and the symbols after a nullable prefix; the
+		# left corners are the transitive closure of that relation
+		direct = {}
+
+		def corners(lhs):
+			if lhs not in direct:
+				found = direct[lhs] = set()
+				for rhs in self.LHS.get(lhs, ()):
+					for x in rhs:
+						found.add(x)
+						if x not in self.NULLABLE:
+							break
+			return direct[lhs]
+
+		result = {}
+		for lhs in symbols:
+			closure = set()
+			agenda = list(corners(lhs))
+			while agenda:
+				x = agenda.pop()
+				if x not in closure:
+					closure.add(x)
+					if x in self.LHS:
+						agenda.extend(corners(x))
+			result[lhs] = closure
+		return result
+
+	def addRule(self, lhs, rhs, probability=None):
+		"""Add the rule lhs -> rhs and update the indexes. Return False if
+		the grammar has the rule already.
+
+		The left corners are extended only for lhs and the symbols that
+		have lhs as a left corner. If the rule makes lhs nullable, NULLABLE
+		and LC are built again."""
+		rhs = tuple(rhs)
+		if not self.__addrule__(lhs, rhs, probability):
+			return False
+		if len(rhs) > 0:
+			self.FIRST.setdefault(rhs[0], []).append((lhs, rhs))
+		self.__normalize__(lhs)
+		if lhs not in self.NULLABLE and all(x in self.NULLABLE for x in rhs):
+			self.NULLABLE = self.__nullable__()
+			self.LC = self.__leftcorners__(self.LHS)
+		else:
+			added = set()
+			for x in rhs:
+				added.add(x)
+				added.update(self.LC.get(x, ()))
+				if x not in self.NULLABLE:
+					break
+			self.LC.setdefault(lhs, set())
+			for (symbol, corners) in self.LC.items():
+				if symbol == lhs or lhs in corners:
+					corners.update(added)
+		self.version += 1
+		return True
+
+	def removeRule(self, lhs, rhs):
+		"""Remove the rule lhs -> rhs and update the indexes. Return False if
+		the grammar does not have the rule.
+
+		The left corners are built again only for lhs and the symbols that
+		have lhs as a left corner. If the rule was the last one of lhs, or
+		lhs might not be nullable any more, NULLABLE and LC are built
+		again."""
+		rhs = tuple(rhs)
+		if (lhs, rhs) not in self.RULES:
+			return False
+		self.RULES.remove((lhs, rhs))
+		self.WEIGHTS.pop((lhs, rhs), None)
+		del self.PROB[(lhs, rhs)]
+		self.LHS[lhs].remove(rhs)
+		if not self.LHS[lhs]:
+			del self.LHS[lhs]
+		else:
+			self.__normalize__(lhs)
+		self.RHS[rhs].remove(lhs)
+		if not self.RHS[rhs]:
+			del self.RHS[rhs]
+		if len(rhs) > 0:
+			self.FIRST[rhs[0]].remove((lhs, rhs))
+			if not self.FIRST[rhs[0]]:
+				del self.FIRST[rhs[0]]
+		if lhs not in self.LHS or (lhs in self.NULLABLE and all(x in self.NULLABLE for x in rhs)):
+			self.NULLABLE = self.__nullable__()
+			self.LC = self.__leftcorners__(self.LHS)
+		else:
+			self.LC.update(self.__leftcorners__([x for x in self.LC if x == lhs or lhs in self.LC[x]]))
+		self.version += 1
+		return True
+
+	def isTerminal(self, symbol):
+		"""Return True if the symbol is not a left-hand-side."""
+		return symbol not in self.LHS
+
+	def isNullable(self, symbol):
+		"""Return True if the symbol derives the empty string."""
+		return symbol in self.NULLABLE
+
+	def getLeftCorners(self, symbol):
+		"""Return the set of left corners of a symbol."""
+		return self.LC.get(symbol, set())
+
+	def getRulesByFirst(self, symbol):
+		"""Return the rules (lhs, rhs) with the symbol as the first
+		right-hand-side symbol."""
+		return self.FIRST.get(symbol, [])
 
 	def getRHS(self, left):
 		"""Return the RHS for a LHS."""
@@ -103,8 +467,303 @@ class PSG:
 		"""Return LHS for a RHS."""
 		return self.RHS.get(right, [])
 
+	def getProbability(self, lhs, rhs):
+		"""Return the probability of the rule lhs -> rhs, 0.0 for rules
+		that are not in the grammar."""
+		return self.PROB.get((lhs, rhs), 0.0)
+
+	def compile(self):
+		"""Return the read-only CompiledPSG of the grammar, for parsers."""
+		return CompiledPSG(self)
+
+
+class CompiledPSG:
+	"""
+	Compiled grammar class, made by PSG.compile():
+	The symbols are interned to integers and the rules are stored in flat
+	arrays of integers. The structure is read-only, changes to the PSG
+	need a new compile().
+	
+	symbols: tuple of the symbol strings by number. The non-terminals are
+	0 ... nonterminals - 1, with the start symbol first, the terminals
+	follow in sorted order.
+	
+	index: dictionary with the non-terminal strings as keys and their
+	numbers as values. The terminals are found by bisection in symbols,
+	see intern().
+	
+	ruleLHS: array with the left-hand-side of every rule. The rules are
+	sorted by left-hand-side, the rules of the non-terminal A are
+	lhsStart[A] ... lhsStart[A + 1] - 1.
+	
+	rhs, rhsStart: the right-hand-side of the rule r is
+	rhs[rhsStart[r]:rhsStart[r + 1]].
+	
+	firstRules, firstStart: the rules with the symbol x as first
+	right-hand-side symbol are firstRules[firstStart[x]:firstStart[x + 1]].
+	
+	logprob: array with the natural logarithm of the probability of
+	every rule, -inf for rules with probability 0.
+	
+	nullable: bytearray with 1 for the nullable symbols.
+	
+	LC: tuple with the set of left corners of every symbol (empty for
+	terminals).
+	
+	CompiledPSG.load() reads a grammar file through a cache of the compiled
+	form, the flat arrays are stored as bytes, such that worker processes
+	start without reading the rules or running compile().
+	"""
+
+	cacheVersion = 1
+
+	def __init__(self, grammar):
+		"""Constructor."""
+		nonterminals = list(grammar.LHS.keys())
+		if grammar.start in grammar.LHS:
+			nonterminals.remove(grammar.start)
+			nonterminals.insert(0, grammar.start)
+		terminals = set()
+		for lhs in nonterminals:
+			for rhs in grammar.LHS[lhs]:
+				terminals.update(x for x in rhs if x not in grammar.LHS)
+		self.symbols = tuple(nonterminals + sorted(terminals))
+		self.index = dict((x, i) for (i, x) in enumerate(nonterminals))
+		self.nonterminals = len(nonterminals)
+		self.start = self.index.get(grammar.start, -1)
+		symbols = dict((x, i) for (i, x) in enumerate(self.symbols))
+
+		self.ruleLHS  = array("i")
+		self.lhsStart = array("i")
+		self.rhs      = array("i")
+		self.rhsStart = array("i", [0])
+		self.logprob  = array("d")
+		for (a, lhs) in enumerate(nonterminals):
+			self.lhsStart.append(len(self.ruleLHS))
+			for rhs in grammar.LHS[lhs]:
+				self.ruleLHS.append(a)
+				probability = grammar.getProbability(lhs, rhs)
+				self.logprob.append(math.log(probability) if probability > 0.0 else float("-inf"))
+				self.rhs.extend(symbols[x] for x in rhs)
+				self.rhsStart.append(len(self.rhs))
+		self.lhsStart.append(len(self.ruleLHS))
+
+		first = [[] for x in self.symbols]
+		for r in range(len(self.ruleLHS)):
+			if self.rhsStart[r] < self.rhsStart[r + 1]:
+				first[self.rhs[self.rhsStart[r]]].append(r)
+		self.firstRules = array("i")
+		self.firstStart = array("i", [0])
+		for rules in first:
+			self.firstRules.extend(rules)
+			self.firstStart.append(len(self.firstRules))
+
+		self.nullable = bytearray(len(self.symbols))
+		for x in grammar.NULLABLE:
+			self.nullable[symbols[x]] = 1
+		empty = frozenset()
+		self.LC = tuple([frozenset(symbols[x] for x in grammar.getLeftCorners(lhs)) for lhs in nonterminals] + [empty] * len(terminals))
+
+	@classmethod
+	def load(cls, filename, cache=True):
+		"""Return the CompiledPSG of a grammar file. With cache=True (or a
+		file name) it is loaded from a cache file next to the grammar file,
+		by default the grammar file name with ".compiled" appended, with a
+		single read and without the PSG, as long as the grammar file does
+		not change (see readCache). Otherwise the grammar file is read and
+		compiled, and the cache file is written for the next time."""
+		if cache is True:
+			cache = filename + ".compiled"
+		if cache:
+			state = readCache(filename, cache, cls.cacheVersion)
+			if state is not None and state[0] == (sys.byteorder, array("i").itemsize):
+				compiled = cls.__new__(cls)
+				compiled.__loadstate__(state)
+				return compiled
+		compiled = PSG(filename).compile()
+		if cache:
+			try:
+				writeCache(filename, cache, cls.cacheVersion, compiled.__state__())
+			except (IOError, OSError):
+				pass   # the cache is only an optimization
+		return compiled
+
+	def __state__(self):
+		"""Return the compiled grammar as a tuple of bytes and numbers for
+		the cache: the symbols are joined with newlines (symbols from files
+		have no white space), the arrays are stored with tobytes() and the
+		left corners of the non-terminals as the arrays corners and
+		cornerStart, like the rules. The byte order and the size of the
+		integers come first, the arrays are only valid on the same kind of
+		machine. This is a hidden method."""
+		corners = array("i")
+		cornerStart = array("i", [0])
+		for x in range(self.nonterminals):
+			corners.extend(sorted(self.LC[x]))
+			cornerStart.append(len(corners))
+		arrays = (self.ruleLHS, self.lhsStart, self.rhs, self.rhsStart, self.logprob, self.firstRules, self.firstStart, corners, cornerStart)
+		return ((sys.byteorder, array("i").itemsize), "\n".join(self.symbols).encode("utf-8"), self.nonterminals, self.start, bytes(self.nullable)) + tuple(x.tobytes() for x in arrays)
+
+	def __loadstate__(self, state):
+		"""Set the compiled grammar from a tuple of __state__(). This is a
+		hidden method."""
+		(machine, symbols, self.nonterminals, self.start, nullable) = state[:5]
+		symbols = symbols.decode("utf-8")
+		self.symbols = tuple(symbols.split("\n")) if symbols else ()
+		self.index = dict((x, i) for (i, x) in enumerate(self.symbols[:self.nonterminals]))
+		self.nullable = bytearray(nullable)
+		arrays = []
+		for (code, data) in zip("iiiidiiii", state[5:]):
+			x = array(code)
+			x.frombytes(data)
+			arrays.append(x)
+		(self.ruleLHS, self.lhsStart, self.rhs, self.rhsStart, self.logprob, self.firstRules, self.firstStart, corners, cornerStart) = arrays
+		empty = frozenset()
+		self.LC = tuple([frozenset(corners[cornerStart[x]:cornerStart[x + 1]]) for x in range(self.nonterminals)] + [empty] * (len(self.symbols) - self.nonterminals))
+
+	def __len__(self):
+		"""Return the number of rules."""
+		return len(self.ruleLHS)
+
+	def intern(self, symbol):
+		"""Return the number of a symbol, -1 for unknown symbols. The
+		terminals are found by bisection, they are sorted."""
+		x = self.index.get(symbol, -1)
+		if x < 0:
+			x = bisect_left(self.symbols, symbol, self.nonterminals)
+			if x == len(self.symbols) or self.symbols[x] != symbol:
+				return -1
+		return x
+
+	def isTerminal(self, x):
+		"""Return True if the symbol number x is a terminal."""
+		return x >= self.nonterminals
+
+	def isNullable(self, x):
+		"""Return True if the symbol number x derives the empty string."""
+		return self.nullable[x] == 1
+
+	def getLeftCorners(self, x):
+		"""Return the set of left corners of the symbol number x."""
+		return self.LC[x]
+
+	def getRules(self, lhs):
+		"""Return the rule numbers for a left-hand-side number."""
+		return range(self.lhsStart[lhs], self.lhsStart[lhs + 1])
+
+	def getRulesByFirst(self, x):
+		"""Return the rule numbers with x as first right-hand-side symbol."""
+		return self.firstRules[self.firstStart[x]:self.firstStart[x + 1]]
+
+	def getRulesByRHS(self, right):
+		"""Return the rule numbers for a right-hand-side tuple of numbers,
+		found among the rules with the same first symbol."""
+		if not right:
+			return tuple(r for r in range(len(self.ruleLHS)) if self.rhsStart[r] == self.rhsStart[r + 1])
+		if not 0 <= right[0] < len(self.symbols):
+			return ()
+		return tuple(r for r in self.getRulesByFirst(right[0]) if self.getRHS(r) == right)
+
+	def getRHS(self, rule):
+		"""Return the right-hand-side of a rule as a tuple of numbers."""
+		return tuple(self.rhs[self.rhsStart[rule]:self.rhsStart[rule + 1]])
+
+	def ruleLength(self, rule):
+		"""Return the length of the right-hand-side of a rule."""
+		return self.rhsStart[rule + 1] - self.rhsStart[rule]
+
+
+class LiveGrammar:
+	"""
+	A grammar for long-running services, that can be changed and reloaded
+	while parses are running:
+	
+	grammar: the PSG, changed in place by update() and replaced by
+	reload().
+	
+	factory: function that makes the parser (or anything else that is
+	needed for parsing) from a CompiledPSG, e.g. chartparser.EarleyParser.
+	
+	The current generation (the number of the swap), CompiledPSG and
+	parser are swapped together by the assignment of a single tuple, the
+	snapshot. A parse has to take the snapshot (or the parser) once and
+	keep it until it is done: running parses finish with the grammar they
+	started with, new parses get the new grammar. A new compiled grammar
+	and parser are made before the swap, a failure leaves the old ones in
+	place.
+	"""
+
+	def __init__(self, filename=None, grammar=None, factory=None, cache=False):
+		"""Constructor, for a grammar file or a PSG."""
+		if grammar is None:
+			grammar = PSG(filename, cache=cache)
+		self.filename = filename or grammar.filename
+		self.cache = cache
+		self.factory = factory
+		self.grammar = grammar
+		self.lock = threading.Lock()
+		self._info = self.__fileinfo__()
+		self._snapshot = (0,) + self.__build__(grammar)
+
+	def __fileinfo__(self):
+		"""Return the modification time and size of the grammar file, None
+		without file. This is a hidden method."""
+		if self.filename is None:
+			return None
+		info = os.stat(self.filename)
+		return (info.st_mtime, info.st_size)
+
+	def __build__(self, grammar):
+		"""Return the CompiledPSG and parser of a grammar. This is a hidden
+		method."""
+		compiled = grammar.compile()
+		return (compiled, self.factory(compiled) if self.factory else None)
+
+	def snapshot(self):
+		"""Return the tuple (generation, CompiledPSG, parser)."""
+		return self._snapshot
+
+	@property
+	def generation(self):
+		return self._snapshot[0]
+
+	@property
+	def compiled(self):
+		return self._snapshot[1]
+
+	@property
+	def parser(self):
+		return self._snapshot[2]
+
+	def update(self, add=(), remove=()):
+		"""Remove and add rules, (lhs, rhs) or (lhs, rhs, probability), with
+		incremental index updates, and swap in the new grammar. Return the
+		new generation."""
+		with self.lock:
+			for rule in remove:
+				self.grammar.removeRule(rule[0], rule[1])
+			for rule in add:
+				self.grammar.addRule(*rule)
+			built = self.__build__(self.grammar)
+			self._snapshot = (self._snapshot[0] + 1,) + built
+			return self._snapshot[0]
+
+	def reload(self, force=False):
+		"""Read the grammar file again if it changed (or with force) and swap
+		in the new grammar. Return True if the grammar was swapped."""
+		with self.lock:
+			info = self.__fileinfo__()
+			if info is None or (info == self._info and not force):
+				return False
+			grammar = PSG(self.filename, cache=self.cache)
+			built = self.__build__(grammar)
+			self.grammar = grammar
+			self._info = info
+			self._snapshot = (self._snapshot[0] + 1,) + built
+			return True
+
 
 if __name__ == "__main__":
 	if len(sys.argv) > 1:
 		myGrammar = PSG(sys.argv[1])
-		print myGrammar
+		print(myGrammar)
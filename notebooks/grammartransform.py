@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+
+"""
+Filename: grammartransform.py
+
+Transformations of a grammar.PSG for efficient parsing:
+
+useless: remove the rules with symbols that do not derive any string of
+terminals, or that cannot be reached from the start symbol.
+
+epsilon: remove the rules with an empty right-hand-side; a rule with
+nullable symbols is replaced by its variants without them. If the start
+symbol is nullable, a new start symbol is added with a rule for the
+empty string.
+
+unary: replace the unary rules A -> B of non-terminals by their closure,
+A gets the rules of every non-terminal that A derives by unary rules.
+
+binarize: replace the rules with more than two right-hand-side symbols
+by chains of binary rules with new intermediate symbols, shared by the
+rules with the same left-hand-side and right-hand-side suffix, and
+replace the terminals in rules with more than one symbol by new
+pre-terminals.
+
+The steps in CNF give a grammar in Chomsky Normal Form for the CYKParser
+and the ViterbiParser. Every step keeps back-pointers from the new rules
+to the rules of its input grammar, such that the trees of the transformed
+grammar can be mapped back to trees of the original grammar. If a rule
+has more than one source, the most probable one is kept (the first one
+for grammars without probabilities), as well as its probability.
+
+Example:
+
+	from grammar import PSG
+	from grammartransform import transform
+	from chartparser import CYKParser, treeToString
+
+	transformed = transform(PSG("mygrammar.txt"), cache=True)
+	parser = CYKParser(transformed.grammar)
+	for tree in parser.parse("John loves Mary".split()):
+		print(treeToString(transformed.unmap(tree)))
+"""
+
+from grammar import PSG, readCache, writeCache
+
+
+CNF = ("useless", "epsilon", "unary", "binarize", "useless")
+
+cacheVersion = 1
+
+
+class Transformation:
+	"""
+	A grammar transformed by a sequence of steps:
+
+	grammar: the transformed PSG.
+
+	steps: the names of the steps.
+
+	back: list with the back-pointers of every step, a dictionary with
+	the new rules (lhs, rhs) as keys and templates as values. A template
+	is the list of the subtrees that replace a node of the rule in the
+	tree of the input grammar of the step: an integer i stands for the
+	subtrees of the child i of the node, a tuple (label, ...) for a node
+	of the input grammar with a template for its children. Rules that are
+	not in back map to themselves.
+	"""
+
+	def __init__(self, grammar, steps, back):
+		self.grammar = grammar
+		self.steps = tuple(steps)
+		self.back = back
+
+	def unmap(self, tree):
+		"""Return the tree of the original grammar for a tree of the
+		transformed grammar."""
+		for back in reversed(self.back):
+			trees = _unmap(back, tree)
+			if len(trees) != 1:
+				raise ValueError("Not a tree of the transformed grammar")
+			tree = trees[0]
+		return tree
+
+
+def _unmap(back, tree):
+	"""Return the list of the subtrees of the input grammar of a step that
+	replace a tree of its output grammar."""
+	if not isinstance(tree, tuple):
+		return [tree]
+	children = [_unmap(back, x) for x in tree[1:]]
+	template = back.get((tree[0], tuple(x[0] if isinstance(x, tuple) else x for x in tree[1:])))
+	if template is None:
+		return [(tree[0],) + tuple(x for child in children for x in child)]
+	return _instantiate(template, children)
+
+
+def _instantiate(template, children):
+	"""Return the list of the subtrees of a template for the children."""
+	result = []
+	for item in template:
+		if isinstance(item, int):
+			result.extend(children[item])
+		else:
+			result.append((item[0],) + tuple(_instantiate(item[1:], children)))
+	return result
+
+
+def _rules(grammar):
+	"""Generate the rules (lhs, rhs, probability) of a grammar, with the
+	probability None for grammars without probabilities."""
+	weighted = len(grammar.WEIGHTS) > 0
+	for lhs in grammar.LHS:
+		for rhs in grammar.LHS[lhs]:
+			yield (lhs, rhs, grammar.PROB[(lhs, rhs)] if weighted else None)
+
+
+def _times(p, q):
+	"""Multiply probabilities, None for grammars without probabilities."""
+	if p is None or q is None:
+		return p
+	return p * q
+
+
+def _better(best, key, probability):
+	"""Return True if a rule with the probability beats the one in best."""
+	return key not in best or (probability is not None and probability > best[key][0])
+
+
+def _fresh(used, name):
+	"""Return a new symbol name based on name, and mark it as used."""
+	while name in used:
+		name += "'"
+	used.add(name)
+	return name
+
+
+def _symbols(grammar):
+	"""Return the set of all the symbols of a grammar."""
+	symbols = set(grammar.LHS)
+	for rhs in grammar.RHS:
+		symbols.update(rhs)
+	return symbols
+
+
+def removeUseless(grammar):
+	"""Return the grammar without useless rules and empty back-pointers."""
+	generating = set()
+	changed = True
+	while changed:
+		changed = False
+		for (lhs, rhs, p) in _rules(grammar):
+			if lhs not in generating and all(x in generating or grammar.isTerminal(x) for x in rhs):
+				generating.add(lhs)
+				changed = True
+	rules = [r for r in _rules(grammar) if r[0] in generating and all(x in generating or grammar.isTerminal(x) for x in r[1])]
+	reachable = set([grammar.start])
+	agenda = [grammar.start]
+	while agenda:
+		x = agenda.pop()
+		for rhs in grammar.getRHS(x):
+			if all(y in generating or grammar.isTerminal(y) for y in rhs):
+				for y in rhs:
+					if y not in reachable:
+						reachable.add(y)
+						agenda.append(y)
+	return (PSG.fromRules([r for r in rules if r[0] in reachable], grammar.start), {})
+
+
+def emptyDerivations(grammar):
+	"""Return a dictionary with the nullable symbols as keys and the pairs
+	(probability, tree) of their most probable derivation of the empty
+	string as values (the probability is None for grammars without)."""
+	empty = {}
+	changed = True
+	while changed:
+		changed = False
+		for (lhs, rhs, p) in _rules(grammar):
+			if all(x in empty for x in rhs):
+				for x in rhs:
+					p = _times(p, empty[x][0])
+				if _better(empty, lhs, p):
+					empty[lhs] = (p, (lhs,) + tuple(empty[x][1] for x in rhs))
+					changed = True
+	return empty
+
+
+def removeEpsilon(grammar):
+	"""Return the grammar without rules for the empty string (except for
+	a new start symbol) and the back-pointers."""
+	empty = emptyDerivations(grammar)
+	variants = []
+	for (lhs, rhs, p) in _rules(grammar):
+		nullable = [i for (i, x) in enumerate(rhs) if x in empty]
+		# every subset of the nullable symbols can be left out
+		for mask in range(1 << len(nullable)):
+			omitted = set(nullable[k] for k in range(len(nullable)) if mask & (1 << k))
+			right = tuple(x for (i, x) in enumerate(rhs) if i not in omitted)
+			if not right:
+				continue
+			probability = p
+			template = []
+			for (i, x) in enumerate(rhs):
+				if i in omitted:
+					probability = _times(probability, empty[x][0])
+					template.append(empty[x][1])
+				else:
+					template.append(i - len([k for k in omitted if k < i]))
+			variants.append((len(omitted), lhs, right, probability, [(lhs,) + tuple(template)] if omitted else None))
+	# the variants with less omitted symbols come first, they win ties
+	variants.sort(key=lambda x: x[0])
+	best = {}
+	for (size, lhs, right, probability, template) in variants:
+		if _better(best, (lhs, right), probability):
+			best[(lhs, right)] = (probability, template)
+	start = grammar.start
+	rules = []
+	back = {}
+	if start in empty:
+		start = _fresh(_symbols(grammar), start + "0")
+		weighted = len(grammar.WEIGHTS) > 0
+		rules.append((start, (grammar.start,), 1.0 if weighted else None))
+		rules.append((start, (), empty[grammar.start][0]))
+		back[(start, (grammar.start,))] = [0]
+		back[(start, ())] = [empty[grammar.start][1]]
+	for ((lhs, right), (probability, template)) in best.items():
+		rules.append((lhs, right, probability))
+		if template is not None:
+			back[(lhs, right)] = template
+	return (PSG.fromRules(rules, start), back)
+
+
+def unaryClosure(grammar):
+	"""Return the unary closure of a grammar: a dictionary with every
+	non-terminal A as key and a dictionary as value, with the non-terminals
+	B that A derives by unary rules (A included) as keys and the pairs
+	(probability, chain) of the most probable derivation as values, the
+	chain is the tuple of the non-terminals A ... B of the derivation.
+	For grammars without probabilities the shortest derivation is used,
+	with the probability None."""
+	closure = {}
+	for a in grammar.LHS:
+		weighted = len(grammar.WEIGHTS) > 0
+		best = {a: (1.0 if weighted else None, (a,))}
+		agenda = [a]
+		while agenda:
+			x = agenda.pop(0)
+			for rhs in grammar.getRHS(x):
+				if len(rhs) == 1 and not grammar.isTerminal(rhs[0]):
+					p = _times(best[x][0], grammar.getProbability(x, rhs))
+					if _better(best, rhs[0], p):
+						best[rhs[0]] = (p, best[x][1] + rhs)
+						agenda.append(rhs[0])
+		closure[a] = best
+	return closure
+
+
+def collapseUnary(grammar):
+	"""Return the grammar without unary rules of non-terminals, with their
+	closure, and the back-pointers."""
+	closure = unaryClosure(grammar)
+	best = {}
+	for a in grammar.LHS:
+		for (b, (q, chain)) in closure[a].items():
+			for rhs in grammar.getRHS(b):
+				if len(rhs) == 1 and not grammar.isTerminal(rhs[0]):
+					continue
+				p = _times(q, grammar.getProbability(b, rhs)) if grammar.WEIGHTS else None
+				if _better(best, (a, rhs), p):
+					template = None
+					if len(chain) > 1:
+						template = (b,) + tuple(range(len(rhs)))
+						for x in reversed(chain[:-1]):
+							template = (x, template)
+						template = [template]
+					best[(a, rhs)] = (p, template)
+	rules = []
+	back = {}
+	for ((lhs, rhs), (probability, template)) in best.items():
+		rules.append((lhs, rhs, probability))
+		if template is not None:
+			back[(lhs, rhs)] = template
+	return (PSG.fromRules(rules, grammar.start), back)
+
+
+def binarize(grammar, lift=True):
+	"""Return the grammar with binary rules and the back-pointers; with
+	lift the terminals in rules with more than one right-hand-side symbol
+	are replaced by new pre-terminals."""
+	used = _symbols(grammar)
+	weighted = len(grammar.WEIGHTS) > 0
+	certain = 1.0 if weighted else None
+	rules = []
+	back = {}
+	lifted = {}
+	intermediate = {}
+	for (lhs, rhs, p) in _rules(grammar):
+		if lift and len(rhs) > 1:
+			right = []
+			for x in rhs:
+				if grammar.isTerminal(x):
+					if x not in lifted:
+						lifted[x] = _fresh(used, "<" + x + ">")
+						rules.append((lifted[x], (x,), certain))
+						back[(lifted[x], (x,))] = [0]
+					x = lifted[x]
+				right.append(x)
+			rhs = tuple(right)
+		# lhs -> X1 lhs|<X2-...-Xn>, lhs|<X2-...-Xn> -> X2 lhs|<X3-...-Xn>,
+		# ...; the intermediate symbols are spliced out of the trees by the
+		# templates [0, 1] of their rules
+		base = lhs
+		while len(rhs) > 2:
+			suffix = rhs[1:]
+			if (base, suffix) not in intermediate:
+				intermediate[(base, suffix)] = _fresh(used, base + "|<" + "-".join(suffix) + ">")
+			name = intermediate[(base, suffix)]
+			rules.append((lhs, (rhs[0], name), p))
+			if lhs != base:
+				back[(lhs, (rhs[0], name))] = [0, 1]
+			(lhs, rhs, p) = (name, suffix, certain)
+		rules.append((lhs, rhs, p))
+		if lhs != base:
+			back[(lhs, rhs)] = [0, 1]
+	return (PSG.fromRules(rules, grammar.start), back)
+
+
+STEPS = {"useless": removeUseless, "epsilon": removeEpsilon, "unary": collapseUnary, "binarize": binarize}
+
+
+def transform(grammar, steps=CNF, cache=False):
+	"""Return the Transformation of the grammar by the steps, by default
+	to Chomsky Normal Form. With cache=True (or a file name), the result is
+	stored in a cache file next to the grammar file, by default with the
+	steps and ".cache" appended to its name, and loaded from there as long
+	as the grammar file does not change (see grammar.readCache). The cache
+	is keyed by the grammar file, changes of the PSG in memory are not
+	seen."""
+	steps = tuple(steps)
+	if cache is True:
+		cache = grammar.filename + "." + "-".join(steps) + ".cache" if grammar.filename else None
+	if cache:
+		data = readCache(grammar.filename, cache, cacheVersion)
+		if data is not None and tuple(data[0]) == steps:
+			transformed = PSG()
+			transformed.__loadstate__(data[1])
+			transformed.stats["source"] = "cache"
+			transformed.stats["rules"] = len(transformed.RULES)
+			return Transformation(transformed, steps, data[2])
+	transformed = grammar
+	back = []
+	for step in steps:
+		(transformed, pointers) = STEPS[step](transformed)
+		back.append(pointers)
+	if cache:
+		try:
+			writeCache(grammar.filename, cache, cacheVersion, (steps, transformed.__state__(), back))
+		except (IOError, OSError) as e:
+			transformed.stats["cacheError"] = str(e)
+	return Transformation(transformed, steps, back)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+"""
+Filename: morphanalyzer.py
+
+Analyze corpora with a binary foma network (.fsm, .fst) on a pool of
+processes.
+
+The FST objects of foma.py wrap ctypes pointers and cannot be pickled, so
+networks are never sent to the workers: every worker process loads the
+binary file once with FST.load and keeps it. Only the chunks of tokens and
+their analyses go through the pool, with at most maxPending chunks in
+flight, such that corpora of any size can be streamed with bounded memory.
+The results are returned in the order of the tokens, or as the chunks are
+done. Every worker reports the number of its tokens and its time, for the
+tokens per second per worker in stats. The chunks are streamed with
+poolstream.streamChunks, as in corpusparser.py.
+
+Example:
+
+	from morphanalyzer import CorpusAnalyzer
+
+	with CorpusAnalyzer("eng.fst", direction="up") as corpus:
+		for result in corpus.analyzeFile("corpus.txt"):
+			print(result.index, result.token, result.analyses)
+		print(corpus.stats)
+"""
+
+import itertools
+import multiprocessing as mp
+import os
+import time
+from collections import namedtuple
+
+from poolstream import streamChunks
+
+
+AnalysisResult = namedtuple("AnalysisResult", ["index", "token", "analyses"])
+AnalysisResult.__doc__ = """The result of a token: its index in the corpus, the token and the list
+of its analyses (empty for unknown tokens)."""
+
+
+# the network and settings of a worker process, set by _init
+_worker = {}
+
+
+def _init(filename, direction, cacheSize, encoding):
+	"""Initialize a worker process: load the binary network once. An
+	error is kept and raised by the chunks, as in corpusparser."""
+	_worker["error"] = None
+	try:
+		from foma import FST
+		fst = FST.load(os.fsencode(filename))
+	except Exception as e:
+		_worker["error"] = e
+		return
+	if cacheSize:
+		fst.setcache(cacheSize)
+	_worker["fst"] = fst
+	_worker["direction"] = direction
+	_worker["encoding"] = encoding
+
+
+def _analyze_chunk(task):
+	"""Analyze a chunk of tokens in a worker process and return the chunk
+	number, the list of the AnalysisResults, the process id, and the number
+	of tokens and seconds of the chunk."""
+	(number, first, tokens) = task
+	if _worker["error"] is not None:
+		raise _worker["error"]
+	fst = _worker["fst"]
+	encoding = _worker["encoding"]
+	started = time.time()
+	if encoding:
+		words = [x.encode(encoding) if isinstance(x, str) else x for x in tokens]
+	else:
+		words = tokens
+	if _worker["direction"] == "down":
+		pairs = fst.apply_down_batch(words)
+	else:
+		pairs = fst.apply_up_batch(words)
+	results = []
+	for (offset, (word, analyses)) in enumerate(pairs):
+		if encoding:
+			analyses = [x.decode(encoding) for x in analyses]
+		results.append(AnalysisResult(first + offset, tokens[offset], analyses))
+	return (number, results, os.getpid(), len(tokens), time.time() - started)
+
+
+class CorpusAnalyzer:
+	"""
+	Analyze corpora with a binary foma network on a pool of worker
+	processes.
+
+	direction: "up" for an analyzer with the surface forms on the lower
+	side (as lexc analyzers), "down" for the other side.
+
+	cacheSize: size of the FSTcache of every worker, for the frequent
+	tokens, or None.
+
+	encoding: the encoding of str tokens and of the analyses, None to pass
+	bytes through.
+
+	chunkSize tokens are sent to a worker at once, at most maxPending
+	chunks (by default twice the number of processes) are in flight or
+	waiting to be returned in order.
+
+	stats: dictionary with the statistics of the last analysis: tokens,
+	chunks, unknown (tokens without analysis), seconds, tokens_per_sec, and
+	workers, with the tokens, seconds (of analysis) and tokens_per_sec of
+	every worker process by process id.
+	"""
+
+	def __init__(self, filename, direction="up", cacheSize=65536, encoding="utf-8",
+			processes=None, chunkSize=1024, maxPending=None):
+		if direction not in ("up", "down"):
+			raise ValueError("Unknown direction: " + str(direction))
+		if not os.path.isfile(filename):
+			raise IOError("No such network file: " + str(filename))
+		self.processes = processes or mp.cpu_count()
+		self.chunkSize = chunkSize
+		self.maxPending = maxPending or 2 * self.processes
+		self.stats = {}
+		self.pool = mp.Pool(self.processes, initializer=_init,
+			initargs=(filename, direction, cacheSize, encoding))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+		return False
+
+	def close(self):
+		"""Stop the worker processes."""
+		if self.pool is not None:
+			self.pool.terminate()
+			self.pool.join()
+			self.pool = None
+
+	def _chunks(self, tokens):
+		"""Generate the chunks (number, index of the first token, list of
+		tokens) of the tokens."""
+		tokens = iter(tokens)
+		first = 0
+		for number in itertools.count():
+			chunk = list(itertools.islice(tokens, self.chunkSize))
+			if not chunk:
+				return
+			yield (number, first, chunk)
+			first += len(chunk)
+
+	def analyzeFile(self, file, ordered=True):
+		"""Return a generator over the AnalysisResults of the tokens of a
+		file name or an open text stream, split at white space."""
+		if isinstance(file, str):
+			return self._analyzeFile(file, ordered)
+		return self.analyze((token for line in file for token in line.split()), ordered)
+
+	def _analyzeFile(self, filename, ordered):
+		with open(filename, encoding="utf-8") as file:
+			for result in self.analyze((token for line in file for token in line.split()), ordered):
+				yield result
+
+	def analyze(self, tokens, ordered=True):
+		"""Return a generator over the AnalysisResults of an iterable over
+		tokens, in the order of the tokens or, with ordered=False, as they
+		are done."""
+		if self.pool is None:
+			raise ValueError("CorpusAnalyzer is closed")
+		return self._analyze(tokens, ordered)
+
+	def _analyze(self, tokens, ordered):
+		workers = {}
+		stats = self.stats = {"tokens": 0, "chunks": 0, "unknown": 0, "workers": workers}
+		started = time.time()
+		try:
+			for ((number, results, pid, count, seconds), latency) in streamChunks(self.pool, _analyze_chunk, self._chunks(tokens), self.maxPending, ordered):
+				worker = workers.setdefault(pid, {"tokens": 0, "seconds": 0.0})
+				worker["tokens"] += count
+				worker["seconds"] += seconds
+				stats["chunks"] += 1
+				for result in results:
+					stats["tokens"] += 1
+					if not result.analyses:
+						stats["unknown"] += 1
+					yield result
+		finally:
+			stats["seconds"] = time.time() - started
+			stats["tokens_per_sec"] = stats["tokens"] / stats["seconds"] if stats["seconds"] > 0 else 0.0
+			for worker in workers.values():
+				worker["tokens_per_sec"] = worker["tokens"] / worker["seconds"] if worker["seconds"] > 0 else 0.0
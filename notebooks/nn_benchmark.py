@@ -0,0 +1,448 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+nn_benchmark.py
+
+Benchmarks for the NeuralNetwork in nn_notes.py.
+
+dtypes: compares the training throughput (samples per second) and the
+final loss of float32 and float64 networks on the XOR data and on the
+pima-indians-diabetes data in data/.
+
+parallel: the speedup of the parallel training in
+NeuralNetwork.fit_parallel per number of worker processes.
+
+suite: a reproducible benchmark over a grid of data sets (fixed-seed
+synthetic data and the data in data/), layer architectures, batch sizes
+and dtypes. Every case runs in a fresh process and reports the training
+and prediction throughput from the median of several timed runs after a
+warm-up, the peak resident set size and the forward and backward time of
+every layer, taken in the passes of the network, as JSON.
+
+compare: compares two suite results and flags the cases that got slower
+or use more memory than a threshold allows.
+
+Run it from the command line:
+
+    python nn_benchmark.py dtypes --epochs 200 --batch-size 32
+    python nn_benchmark.py parallel --processes 1,2,4,8 [--hogwild]
+    python nn_benchmark.py suite --output before.json
+    python nn_benchmark.py suite --output after.json
+    python nn_benchmark.py compare before.json after.json --threshold 0.1
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+from nn_notes import NeuralNetwork
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, the peak RSS is not reported there
+    resource = None
+
+
+DATADIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+def load_xor():
+    """Returns the XOR features and targets."""
+    X = np.array([[0, 0], [0, 1], [1, 0], [1, 1]], dtype=np.float64)
+    y = np.array([[0], [1], [1], [0]], dtype=np.float64)
+    return X, y
+
+
+def load_pima(filename=os.path.join(DATADIR,
+                                    "pima-indians-diabetes.csv")):
+    """Returns the standardized pima-indians-diabetes features and the
+    targets."""
+    data = np.loadtxt(filename, delimiter=",")
+    X = data[:, :-1]
+    X = (X - X.mean(axis=0)) / X.std(axis=0)
+    return X, data[:, -1:]
+
+
+def load_synthetic(rows=20000, features=32, seed=0):
+    """Returns a fixed-seed synthetic binary classification data set."""
+    rng = np.random.RandomState(seed)
+    X = rng.randn(rows, features)
+    w = rng.randn(features, 1)
+    y = (X.dot(w) > 0).astype(np.float64)
+    return X, y
+
+
+DATASETS = {
+    "xor": (load_xor, [2, 2, 1], 0.5),
+    "pima": (load_pima, [8, 16, 8, 1], 0.01),
+    "synthetic": (load_synthetic, [32, 64, 32, 1], 0.01),
+}
+
+# the hidden layers of the architectures in the benchmark suite; the
+# input and output layers come from the data set
+SUITE_HIDDEN = [[16], [64, 32], [256, 128]]
+SUITE_BATCH_SIZES = [1, 32, 256]
+SUITE_DTYPES = ["float32", "float64"]
+SUITE_DATASETS = ["synthetic", "pima"]
+
+# the metrics that compare checks, and whether higher values are better
+COMPARE_METRICS = {
+    "samples_per_sec": True,
+    "predict_samples_per_sec": True,
+    "peak_rss_kb": False,
+}
+
+
+def benchmark_dtype(X, y, layers, alpha, dtype, epochs, batch_size,
+                    seed=42):
+    """Trains a network with the given dtype and returns its throughput and
+    final loss.
+
+    The weights are initialized from the same seed for every dtype, so the
+    runs only differ in the floating point type."""
+    np.random.seed(seed)
+    model = NeuralNetwork(layers, alpha=alpha, dtype=dtype)
+    X = X.astype(dtype)
+    y = y.astype(dtype)
+    start = time.perf_counter()
+    model.fit(X, y, epochs=epochs, displayUpdate=0, batch_size=batch_size)
+    seconds = time.perf_counter() - start
+    return {
+        "dtype": np.dtype(dtype).name,
+        "seconds": seconds,
+        "samples_per_sec": X.shape[0] * epochs / seconds,
+        "loss": model.calculate_loss(X, y, addBias=True),
+    }
+
+
+def compare_dtypes(epochs=200, batch_size=32,
+                   dtypes=(np.float32, np.float64)):
+    """Returns the benchmark results for every data set and dtype."""
+    results = []
+    for name in ("xor", "pima"):
+        (loader, layers, alpha) = DATASETS[name]
+        X, y = loader()
+        for dtype in dtypes:
+            result = benchmark_dtype(X, y, layers, alpha, dtype, epochs,
+                                     batch_size)
+            result["dataset"] = name
+            results.append(result)
+    return results
+
+
+def parallel_speedup(X, y, layers, alpha, processes, epochs, batch_size,
+                     hogwild=False, seed=42):
+    """Trains a network with fit_parallel for every number of worker
+    processes in 'processes' and returns the times and the speedups
+    relative to the first number of processes."""
+    results = []
+    for n in processes:
+        np.random.seed(seed)
+        model = NeuralNetwork(layers, alpha=alpha)
+        start = time.perf_counter()
+        model.fit_parallel(X, y, epochs=epochs, displayUpdate=0,
+                           batch_size=batch_size, processes=n,
+                           hogwild=hogwild)
+        seconds = time.perf_counter() - start
+        results.append({
+            "processes": n,
+            "seconds": seconds,
+            "samples_per_sec": X.shape[0] * epochs / seconds,
+            "speedup": results[0]["seconds"] / seconds if results else 1.0,
+            "loss": model.calculate_loss(X, y, addBias=True),
+        })
+    return results
+
+
+class _TimedActivation:
+    """Wraps an activation of a network and records the time after every
+    forward and backward call in 'marks', which splits the real passes of
+    the network into layers."""
+
+    def __init__(self, activation, marks):
+        self.activation = activation
+        self.marks = marks
+
+    def __getattr__(self, name):
+        return getattr(self.activation, name)
+
+    def forward(self, *args):
+        self.activation.forward(*args)
+        self.marks.append(time.perf_counter())
+
+    def backward(self, *args):
+        self.activation.backward(*args)
+        self.marks.append(time.perf_counter())
+
+
+def layer_times(model, X, y, batch_size, repeats=20):
+    """Returns the median forward and backward time in seconds of every
+    layer for one batch, and the median time of the weight gradients of all
+    layers.
+
+    The times are taken in NeuralNetwork._forward and
+    NeuralNetwork._gradients themselves, between the calls of the
+    activations of consecutive layers, so the forward time of a layer is
+    its product with the weights and its activation, the backward time its
+    delta."""
+    rows = min(batch_size, X.shape[0])
+    ws = model.workspace(rows)
+    np.copyto(ws.features, X[:rows])
+    np.copyto(ws.Y, y[:rows])
+    n = len(model.W)
+    marks = []
+    activations = model.activations
+    model.activations = [_TimedActivation(a, marks) for a in activations]
+    forward = [[] for layer in range(n)]
+    backward = [[] for layer in range(n)]
+    gradients = []
+    try:
+        # the first pass is a warm-up
+        for r in range(repeats + 1):
+            del marks[:]
+            start = time.perf_counter()
+            model._forward(ws)
+            times = np.diff([start] + marks)
+            del marks[:]
+            start = time.perf_counter()
+            model._gradients(ws)
+            end = time.perf_counter()
+            # the marks of the forward pass, then the backward marks from
+            # the last layer to the first one
+            back = np.diff(marks[n - 1:])
+            if r > 0:
+                for layer in range(n):
+                    forward[layer].append(times[layer])
+                    backward[layer].append(back[n - 1 - layer])
+                gradients.append(end - marks[-1])
+    finally:
+        model.activations = activations
+    return {"weight_gradients_sec": float(np.median(gradients)),
+            "layers": [{"layer": layer,
+                        "shape": list(model.W[layer].shape),
+                        "forward_sec": float(np.median(forward[layer])),
+                        "backward_sec": float(np.median(backward[layer]))}
+                       for layer in range(n)]}
+
+
+def peak_rss_kb():
+    """Returns the peak resident set size of the current process in
+    kilobytes, or None."""
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def _timed(function, repeats):
+    """Calls 'function' once to warm up and then 'repeats' times, and
+    returns the times in seconds of the timed calls."""
+    function()
+    times = []
+    for r in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def run_case(case):
+    """Runs one benchmark suite case in the current process and returns its
+    result.
+
+    Training and prediction are warmed up and then timed 'repeats' times,
+    every training run on a network from the same seed; the throughputs are
+    computed from the median times."""
+    (loader, layers, alpha) = DATASETS[case["dataset"]]
+    X, y = loader()
+    X = X.astype(case["dtype"])
+    y = y.astype(case["dtype"])
+    layers = [X.shape[1]] + case["hidden"] + [y.shape[1]]
+    repeats = case.get("repeats", 5)
+
+    def network():
+        np.random.seed(case["seed"])
+        return NeuralNetwork(layers, alpha=alpha, dtype=case["dtype"])
+
+    def train():
+        network().fit(X, y, epochs=case["epochs"], displayUpdate=0,
+                      batch_size=case["batch_size"])
+
+    train_runs = _timed(train, repeats)
+    model = network()
+    model.fit(X, y, epochs=case["epochs"], displayUpdate=0,
+              batch_size=case["batch_size"])
+    predict_runs = _timed(lambda: model.predict(X), repeats)
+    seconds = float(np.median(train_runs))
+    predict_seconds = float(np.median(predict_runs))
+
+    result = dict(case)
+    result.update({
+        "layers": layers,
+        "repeats": repeats,
+        "train_seconds": seconds,
+        "train_runs": train_runs,
+        "predict_runs": predict_runs,
+        "samples_per_sec": X.shape[0] * case["epochs"] / seconds,
+        "predict_samples_per_sec": X.shape[0] / predict_seconds,
+        "loss": model.calculate_loss(X, y, addBias=True),
+        "layer_times": layer_times(model, X, y, case["batch_size"]),
+        "peak_rss_kb": peak_rss_kb(),
+    })
+    return result
+
+
+def case_key(result):
+    """Returns the key that identifies a suite case across runs."""
+    return "{}/{}/batch={}/{}".format(
+        result["dataset"], "-".join(str(l) for l in result["hidden"]),
+        result["batch_size"], result["dtype"])
+
+
+def run_suite(datasets=SUITE_DATASETS, hidden=SUITE_HIDDEN,
+              batch_sizes=SUITE_BATCH_SIZES, dtypes=SUITE_DTYPES, epochs=3,
+              seed=42, repeats=5, isolate=True):
+    """Runs the benchmark suite over the grid of data sets, hidden layers,
+    batch sizes and dtypes.
+
+    With 'isolate' every case runs in a fresh worker process, so that the
+    peak RSS of a case is not inflated by the cases before it."""
+    cases = [{"dataset": d, "hidden": h, "batch_size": b, "dtype": t,
+              "epochs": epochs, "seed": seed, "repeats": repeats}
+             for d in datasets for h in hidden for b in batch_sizes
+             for t in dtypes]
+    if isolate:
+        with mp.Pool(processes=1, maxtasksperchild=1) as p:
+            results = p.map(run_case, cases, chunksize=1)
+    else:
+        results = [run_case(case) for case in cases]
+    return {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "epochs": epochs,
+            "seed": seed,
+            "repeats": repeats,
+        },
+        "results": results,
+    }
+
+
+def compare(base, new, threshold=0.1):
+    """Compares two suite results and returns the regressions of 'new'
+    against 'base'.
+
+    A regression is a metric in COMPARE_METRICS that is worse by more than
+    the relative 'threshold' in a case that is in both results."""
+    baseline = dict((case_key(r), r) for r in base["results"])
+    regressions = []
+    for r in new["results"]:
+        key = case_key(r)
+        if key not in baseline:
+            continue
+        for (metric, higher_is_better) in COMPARE_METRICS.items():
+            (old, value) = (baseline[key].get(metric), r.get(metric))
+            if not old or value is None:
+                continue
+            change = (value - old) / old
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append({"case": key, "metric": metric,
+                                    "base": old, "new": value,
+                                    "change": change})
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the NeuralNetwork training and inference.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    dtypes = commands.add_parser("dtypes",
+                                 help="compare float32 and float64 training")
+    dtypes.add_argument("--epochs", type=int, default=200)
+    dtypes.add_argument("--batch-size", type=int, default=32)
+
+    parallel = commands.add_parser(
+        "parallel", help="speedup of fit_parallel per worker count")
+    parallel.add_argument("--processes", default="1,2,4",
+                          help="comma separated worker counts")
+    parallel.add_argument("--hogwild", action="store_true",
+                          help="use asynchronous updates")
+    parallel.add_argument("--epochs", type=int, default=200)
+    parallel.add_argument("--batch-size", type=int, default=32)
+
+    suite = commands.add_parser("suite",
+                                help="run the benchmark suite and write JSON")
+    suite.add_argument("--output",
+                       help="JSON output file, standard output by default")
+    suite.add_argument("--epochs", type=int, default=3)
+    suite.add_argument("--seed", type=int, default=42)
+    suite.add_argument("--repeats", type=int, default=5,
+                       help="timed runs per case, after a warm-up")
+    suite.add_argument("--datasets", default=",".join(SUITE_DATASETS))
+    suite.add_argument("--batch-sizes",
+                       default=",".join(str(b) for b in SUITE_BATCH_SIZES))
+    suite.add_argument("--dtypes", default=",".join(SUITE_DTYPES))
+
+    comparison = commands.add_parser(
+        "compare", help="flag regressions between two suite results")
+    comparison.add_argument("base")
+    comparison.add_argument("new")
+    comparison.add_argument("--threshold", type=float, default=0.1,
+                            help="relative change that counts as a "
+                            "regression")
+
+    args = parser.parse_args()
+    if args.command == "dtypes":
+        print("{:<8} {:<8} {:>14} {:>10} {:>12}".format(
+            "dataset", "dtype", "samples/sec", "seconds", "loss"))
+        for r in compare_dtypes(args.epochs, args.batch_size):
+            print("{:<8} {:<8} {:>14.0f} {:>10.3f} {:>12.6f}".format(
+                r["dataset"], r["dtype"], r["samples_per_sec"],
+                r["seconds"], r["loss"]))
+    elif args.command == "parallel":
+        X, y = load_pima()
+        counts = [int(n) for n in args.processes.split(",")]
+        print("{:>9} {:>14} {:>10} {:>8} {:>12}".format(
+            "processes", "samples/sec", "seconds", "speedup", "loss"))
+        for r in parallel_speedup(X, y, [8, 16, 8, 1], 0.01, counts,
+                                  args.epochs, args.batch_size,
+                                  args.hogwild):
+            print("{:>9} {:>14.0f} {:>10.3f} {:>8.2f} {:>12.6f}".format(
+                r["processes"], r["samples_per_sec"], r["seconds"],
+                r["speedup"], r["loss"]))
+    elif args.command == "suite":
+        report = run_suite(
+            datasets=args.datasets.split(","),
+            batch_sizes=[int(b) for b in args.batch_sizes.split(",")],
+            dtypes=args.dtypes.split(","), epochs=args.epochs,
+            seed=args.seed, repeats=args.repeats)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=1)
+        else:
+            print(json.dumps(report, indent=1))
+    else:
+        with open(args.base) as f:
+            base = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        regressions = compare(base, new, args.threshold)
+        for r in regressions:
+            print("REGRESSION {case}: {metric} {base:.6g} -> {new:.6g} "
+                  "({change:+.1%})".format(**r))
+        print("{} regression(s) at a threshold of {:.0%}".format(
+            len(regressions), args.threshold))
+        sys.exit(1 if regressions else 0)
@@ -13,16 +13,381 @@ by Adrian Rosebrock on May 6, 2021
 
 
 # import the necessary packages
+import asyncio
+import json
+import os
+import struct
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing import Pool, shared_memory
+
 import numpy as np
 
+# numexpr is optional; if it is installed, the activation and loss
+# kernels use it for arrays with at least 'numexprMinSize' elements,
+# which evaluates a whole expression in one pass without temporaries
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+numexprMinSize = 65536
+
+
+def _numexpr(x):
+    # check to see if the numexpr path should be used for 'x'
+    return numexpr is not None and x.size >= numexprMinSize
+
+
+class Sigmoid:
+    """
+    The logistic function, the default activation of NeuralNetwork.
+
+    All activations implement the same in-place protocol:
+
+    forward(x, scratch, column) overwrites the net input 'x' with the
+    activation; backward(a, delta, scratch, column) multiplies 'delta'
+    in place by the derivative of the activation function at the
+    activation 'a'. 'scratch' is a buffer shaped like 'x', 'column' a
+    buffer with one column and one row per row of 'x'; both can be
+    overwritten.
+    """
+
+    name = "sigmoid"
+
+    def forward(self, x, scratch, column):
+        # 1 / (1 + exp(-x)) overflows in exp for large negative x; the
+        # equivalent 0.5 + 0.5 * tanh(0.5 * x) does not, and needs no
+        # temporary arrays
+        if _numexpr(x):
+            numexpr.evaluate("0.5 + 0.5 * tanh(0.5 * x)", out=x,
+                casting="same_kind")
+            return
+        np.multiply(x, 0.5, out=x)
+        np.tanh(x, out=x)
+        np.multiply(x, 0.5, out=x)
+        np.add(x, 0.5, out=x)
+
+    def backward(self, a, delta, scratch, column):
+        # the derivative of the sigmoid is a * (1 - a)
+        if _numexpr(a):
+            numexpr.evaluate("delta * a * (1 - a)", out=delta,
+                casting="same_kind")
+            return
+        np.subtract(1.0, a, out=scratch)
+        np.multiply(scratch, a, out=scratch)
+        np.multiply(delta, scratch, out=delta)
+
+
+class Tanh:
+    """The hyperbolic tangent activation, see Sigmoid for the protocol."""
+
+    name = "tanh"
+
+    def forward(self, x, scratch, column):
+        np.tanh(x, out=x)
+
+    def backward(self, a, delta, scratch, column):
+        # the derivative of tanh is 1 - a ** 2
+        if _numexpr(a):
+            numexpr.evaluate("delta * (1 - a * a)", out=delta,
+                casting="same_kind")
+            return
+        np.multiply(a, a, out=scratch)
+        np.subtract(1.0, scratch, out=scratch)
+        np.multiply(delta, scratch, out=delta)
+
+
+class ReLU:
+    """The rectified linear activation, see Sigmoid for the protocol."""
+
+    name = "relu"
+
+    def forward(self, x, scratch, column):
+        np.maximum(x, 0.0, out=x)
+
+    def backward(self, a, delta, scratch, column):
+        # the derivative is 1 where the unit is active, 0 elsewhere
+        np.greater(a, 0.0, out=scratch)
+        np.multiply(delta, scratch, out=delta)
+
+
+class Softmax:
+    """
+    The softmax activation over the units of a layer (the columns of
+    a batch), for output layers; see Sigmoid for the protocol.
+
+    Softmax is the exception to the activations without temporary
+    arrays: NumPy broadcasts the one-column buffer across the rows
+    through its ufunc buffer (np.getbufsize() elements, about 32 KB
+    for float32), which is allocated on every call. It does not grow
+    with the batch, and looping over the units instead to avoid it is
+    several times slower.
+    """
+
+    name = "softmax"
+
+    def forward(self, x, scratch, column):
+        # subtract the row maximum before taking the exponent, so that
+        # exp cannot overflow, then normalize every row by multiplying
+        # with the reciprocal of its sum
+        np.max(x, axis=1, keepdims=True, out=column)
+        np.subtract(x, column, out=x)
+        np.exp(x, out=x)
+        np.sum(x, axis=1, keepdims=True, out=column)
+        np.reciprocal(column, out=column)
+        np.multiply(x, column, out=x)
+
+    def backward(self, a, delta, scratch, column):
+        # multiply 'delta' with the Jacobian of the softmax, which is
+        # a * (delta - sum(delta * a)) for every row
+        np.multiply(delta, a, out=scratch)
+        np.sum(scratch, axis=1, keepdims=True, out=column)
+        np.subtract(delta, column, out=delta)
+        np.multiply(delta, a, out=delta)
+
+
+# the activations by name, for the 'activation' and 'outputActivation'
+# arguments of NeuralNetwork
+ACTIVATIONS = {
+    "sigmoid": Sigmoid,
+    "tanh": Tanh,
+    "relu": ReLU,
+    "softmax": Softmax,
+}
+
+
+def squared_error(predictions, targets, scratch):
+    # the fused loss kernel: half the sum of the squared errors of
+    # the predictions, using 'scratch' for the error
+    if _numexpr(predictions):
+        return 0.5 * float(numexpr.evaluate("sum((p - t) ** 2)",
+            local_dict={"p": predictions, "t": targets}))
+    np.subtract(predictions, targets, out=scratch)
+    return 0.5 * float(np.vdot(scratch, scratch))
+
+
+def _share(array, blocks):
+    # copy an array into a new block of shared memory, append the block
+    # to 'blocks' and return the array view of the shared copy with its
+    # picklable description for '_attach'
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    blocks.append(shm)
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shared[...] = array
+    return (shared, (shm.name, array.shape, array.dtype.str))
+
+
+def _attach(spec, blocks):
+    # attach to the shared array described by 'spec'; the creating
+    # process owns the block, so it is not tracked (and unlinked) here
+    (name, shape, dtype) = spec
+    try:
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 has no 'track' argument
+        shm = shared_memory.SharedMemory(name=name)
+    blocks.append(shm)
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+# the state of a worker process in NeuralNetwork.fit_parallel
+_parallel = {}
+
+
+def _parallel_init(state, W, data, G):
+    # build the network of this worker on the shared weights, and
+    # attach to the shared data and gradient buffers
+    blocks = []
+    network = NeuralNetwork.__new__(NeuralNetwork)
+    network.__dict__.update(state)
+    network.W = [_attach(spec, blocks) for spec in W]
+    network.workspaces = {}
+    _parallel["network"] = network
+    _parallel["X"], _parallel["y"] = [_attach(spec, blocks) for spec in data]
+    _parallel["G"] = [[_attach(spec, blocks) for spec in grads]
+        for grads in G]
+    _parallel["blocks"] = blocks
+
+
+def _parallel_gradients(task):
+    # compute the gradients of one batch into the shared gradient
+    # buffers of its shard, and return the loss of the batch
+    (shard, start, stop) = task
+    network = _parallel["network"]
+    for (ws, lo, hi) in network._batches(_parallel["X"][start:stop],
+            _parallel["y"][start:stop], stop - start):
+        loss = network._gradients(ws)
+        for (g, shared) in zip(ws.G, _parallel["G"][shard]):
+            np.copyto(shared, g)
+    return loss
+
+
+def _parallel_hogwild(task):
+    # train on the rows of one shard, updating the shared weights,
+    # and return the running loss of the shard
+    (start, stop, batch_size) = task
+    network = _parallel["network"]
+    loss = 0.0
+    for (ws, lo, hi) in network._batches(_parallel["X"][start:stop],
+            _parallel["y"][start:stop], batch_size):
+        loss += network._train_step(ws)
+    return loss
+
+
+class History:
+    """
+    Training callback that collects the metrics of every epoch in the
+    list 'history'.
+
+    A training callback is an object with an 'on_epoch_end(network,
+    metrics)' method, or a function 'callback(network, metrics)'. The
+    metrics are a dictionary with the keys
+
+    epoch: the number of the epoch, starting at 1
+    samples: the number of samples trained on in the epoch
+    epoch_time: the wall time of the epoch in seconds
+    samples_per_sec: the training throughput of the epoch
+    loss: the running training loss of the epoch, the sum of the loss
+        of every batch computed in the forward pass of its training step
+    mean_loss: the running training loss per sample
+    val_loss: the loss on the validation set, if one is given
+    """
+
+    def __init__(self):
+        self.history = []
+
+    def on_epoch_end(self, network, metrics):
+        self.history.append(metrics)
+
+
+class ProgressPrinter:
+    """Training callback that prints the metrics every 'every' epochs."""
+
+    def __init__(self, every=100):
+        self.every = every
+
+    def on_epoch_end(self, network, metrics):
+        # check to see if we should display a training update
+        epoch = metrics["epoch"]
+        if epoch == 1 or epoch % self.every == 0:
+            line = "[INFO] epoch={}, loss={:.7f}".format(epoch,
+                metrics["loss"])
+            if "val_loss" in metrics:
+                line += ", val_loss={:.7f}".format(metrics["val_loss"])
+            print(line)
+
+
+class Workspace:
+    """
+    Preallocated buffers for the forward and backward passes of a
+    NeuralNetwork over batches with a fixed number of rows.
+
+    X: input batch, with the bias column of 1's as the last column
+    Y: target batch
+    A: output activations of every layer
+    D: deltas of every layer
+    T: scratch buffers for the activation functions
+    C: a one column scratch buffer for row reductions
+    G: gradients, shaped like the weight matrices
+    """
+
+    def __init__(self, network, rows):
+        self.rows = rows
+
+        # the input buffer carries the bias column, which is set to 1
+        # once here and never overwritten -- copying a batch into the
+        # feature columns is all it takes to add the bias
+        dtype = network.dtype
+        self.X = np.ones((rows, network.layers[0] + 1), dtype=dtype)
+        self.features = self.X[:, :-1]
+        self.Y = np.empty((rows, network.layers[-1]), dtype=dtype)
+
+        # one activation, delta and scratch buffer per weight matrix,
+        # and one gradient buffer shaped like each weight matrix, all
+        # in the dtype of the network
+        shapes = [(rows, w.shape[1]) for w in network.W]
+        self.A = [np.empty(shape, dtype=dtype) for shape in shapes]
+        self.D = [np.empty(shape, dtype=dtype) for shape in shapes]
+        self.T = [np.empty(shape, dtype=dtype) for shape in shapes]
+        self.C = np.empty((rows, 1), dtype=dtype)
+        self.G = [np.empty(w.shape, dtype=dtype) for w in network.W]
+
+        # the transposed views used in the backward pass are created
+        # once as well; the input of a layer is the activation of the
+        # layer before it, or the input batch for the first layer
+        self.inputsT = [self.X.T] + [a.T for a in self.A[:-1]]
+        self.WT = [w.T for w in network.W]
+
+
+class ChunkedDataset:
+    """
+    A re-iterable source of (X, y) chunks for NeuralNetwork.fit,
+    predict and calculate_loss.
+
+    X and y are arrays or file names of .npy files, which are opened
+    as memory maps, so data sets larger than memory can be read in
+    chunks of 'chunkRows' rows. y is optional for prediction.
+    """
+
+    def __init__(self, X, y=None, chunkRows=65536):
+        if isinstance(X, str):
+            X = np.load(X, mmap_mode="r")
+        if isinstance(y, str):
+            y = np.load(y, mmap_mode="r")
+        self.X = X
+        self.y = y
+        self.chunkRows = chunkRows
+
+    def __len__(self):
+        return self.X.shape[0]
+
+    def __iter__(self):
+        for start in range(0, self.X.shape[0], self.chunkRows):
+            stop = start + self.chunkRows
+            if self.y is None:
+                yield (self.X[start:stop], None)
+            else:
+                yield (self.X[start:stop], self.y[start:stop])
+
+
 class NeuralNetwork:
-    def __init__(self, layers, alpha=0.1):
+    # the maximal number of rows that 'predict' pushes through the
+    # network at once
+    predictRows = 1024
+
+    def __init__(self, layers, alpha=0.1, dtype=np.float64,
+            activation="sigmoid", outputActivation=None):
         # initialize the list of weights matrices, then store the
         # network architecture and learning rate
         self.W = []
         self.layers = layers
         self.alpha = alpha
 
+        # the floating point type of the weights, activations, deltas
+        # and inputs -- np.float32 halves the memory bandwidth of every
+        # pass; inputs of any other type are converted when they are
+        # copied into a workspace
+        self.dtype = np.dtype(dtype)
+        if self.dtype.kind != "f":
+            raise ValueError("dtype must be a floating point type")
+
+        # the activation function of every layer: 'activation' for
+        # the hidden layers, 'outputActivation' (by default the same)
+        # for the output layer; both are names from ACTIVATIONS or
+        # objects with the protocol of Sigmoid
+        if outputActivation is None:
+            outputActivation = activation
+        self.activations = [self._activation(activation)
+            for i in range(len(layers) - 2)]
+        self.activations.append(self._activation(outputActivation))
+
+        # workspaces with the preallocated buffers for the forward and
+        # backward passes, keyed by the number of rows in a batch
+        self.workspaces = {}
+
         # start looping from the index of the first layer but
         # stop before we reach the last two layers
         for i in np.arange(0, len(layers) - 2):
@@ -30,12 +395,21 @@ class NeuralNetwork:
             # number of nodes in each respective layer together,
             # adding an extra node for the bias
             w = np.random.randn(layers[i] + 1, layers[i + 1] + 1)
-            self.W.append(w / np.sqrt(layers[i]))
+            self.W.append((w / np.sqrt(layers[i])).astype(self.dtype))
 
         # the last two layers are a special case where the input
         # connections need a bias term but the output does not
         w = np.random.randn(layers[-2] + 1, layers[-1])
-        self.W.append(w / np.sqrt(layers[-2]))
+        self.W.append((w / np.sqrt(layers[-2])).astype(self.dtype))
+
+    def _activation(self, activation):
+        # look up an activation by name
+        if isinstance(activation, str):
+            if activation not in ACTIVATIONS:
+                raise ValueError("Unknown activation: {}".format(
+                    activation))
+            return ACTIVATIONS[activation]()
+        return activation
 
     def __repr__(self):
         # construct and return a string that represents the network
@@ -45,8 +419,9 @@ class NeuralNetwork:
 
     def sigmoid(self, x):
         # compute and return the sigmoid activation value for a
-        # given input value
-        return 1.0 / (1 + np.exp(-x))
+        # given input value; 0.5 * (1 + tanh(x / 2)) is the same as
+        # 1 / (1 + exp(-x)), but does not overflow
+        return 0.5 * (1.0 + np.tanh(0.5 * np.asarray(x)))
 
     def sigmoid_deriv(self, x):
         # compute the derivative of the sigmoid function ASSUMING
@@ -54,121 +429,577 @@ class NeuralNetwork:
         # function
         return x * (1 - x)
 
-    def fit(self, X, y, epochs=1000, displayUpdate=100):
-        # insert a column of 1's as the last entry in the feature
-        # matrix -- this little trick allows us to treat the bias
-        # as a trainable parameter within the weight matrix
-        X = np.c_[X, np.ones((X.shape[0]))]
+    # the model file format of 'save' and 'load': the magic bytes, the
+    # format version and the length of the JSON header as two little
+    # endian uint32, the header, then the weight matrices in C order
+    # and little endian byte order, every one of them (and the end of
+    # the header) aligned to 'modelAlignment' bytes
+    modelMagic = b"NNNOTES\0"
+    modelVersion = 1
+    modelAlignment = 64
+
+    def save(self, filename):
+        # the weights are stored little endian in the dtype of the
+        # network, at the offsets listed in the header
+        dtype = self.dtype.newbyteorder("<")
+        weights = []
+        offset = 0
+        for w in self.W:
+            weights.append({"offset": offset, "shape": list(w.shape)})
+            offset += self._aligned(w.size * dtype.itemsize)
+        header = json.dumps({
+            "layers": [int(l) for l in self.layers],
+            "alpha": self.alpha,
+            "dtype": dtype.str,
+            "activations": [a.name for a in self.activations],
+            "weights": weights,
+        }).encode("utf-8")
+
+        # the data starts at the first aligned offset after the header;
+        # the weight offsets in the header are relative to it
+        start = self._aligned(len(self.modelMagic) + 8 + len(header))
+        with open(filename, "wb") as file:
+            file.write(self.modelMagic)
+            file.write(struct.pack("<II", self.modelVersion, len(header)))
+            file.write(header)
+            for (w, info) in zip(self.W, weights):
+                file.write(b"\0" * (start + info["offset"] - file.tell()))
+                file.write(np.ascontiguousarray(w, dtype=dtype).tobytes())
+
+    @classmethod
+    def load(cls, filename, mmap_mode="r"):
+        # load a network saved with 'save'; with an 'mmap_mode' the
+        # weights are memory maps of the file (np.memmap modes), so any
+        # number of processes share one copy of the model in the page
+        # cache and nothing is read before it is used; mode "r" gives
+        # read-only weights (for prediction), "c" copy-on-write weights
+        # that can be trained, None reads the weights into memory
+        with open(filename, "rb") as file:
+            magic = file.read(len(cls.modelMagic))
+            if magic != cls.modelMagic:
+                raise ValueError("{} is not a NeuralNetwork model file"
+                    .format(filename))
+            (version, length) = struct.unpack("<II", file.read(8))
+            if version > cls.modelVersion:
+                raise ValueError("Unsupported model file version: {}"
+                    .format(version))
+            header = json.loads(file.read(length).decode("utf-8"))
+            start = cls._aligned(len(cls.modelMagic) + 8 + length)
+
+            network = cls.__new__(cls)
+            network.layers = header["layers"]
+            network.alpha = header["alpha"]
+            network.dtype = np.dtype(header["dtype"]).newbyteorder("=")
+            network.activations = [network._activation(name)
+                for name in header["activations"]]
+            network.workspaces = {}
+            network.W = []
+            for info in header["weights"]:
+                shape = tuple(info["shape"])
+                if mmap_mode:
+                    w = np.memmap(filename, dtype=header["dtype"],
+                        mode=mmap_mode, offset=start + info["offset"],
+                        shape=shape)
+                else:
+                    file.seek(start + info["offset"])
+                    w = np.fromfile(file, dtype=header["dtype"],
+                        count=int(np.prod(shape))).reshape(shape)
+                network.W.append(w)
+        return network
+
+    @classmethod
+    def _aligned(cls, size):
+        # round 'size' up to a multiple of 'modelAlignment'
+        return -(-size // cls.modelAlignment) * cls.modelAlignment
+
+    def workspace(self, rows):
+        # return the workspace for batches with the given number of
+        # rows -- it is created on first use and reused afterwards,
+        # so after warm-up no step allocates new arrays
+        ws = self.workspaces.get(rows)
+        if ws is None:
+            ws = Workspace(self, rows)
+            self.workspaces[rows] = ws
+        return ws
+
+    def fit(self, X, y=None, epochs=1000, displayUpdate=100, batch_size=1,
+            callbacks=None, validation=None, validationSize=None):
+        # 'X' and 'y' are either arrays (np.memmap included, e.g. from
+        # np.load(..., mmap_mode="r")), or X is a source of (X, y)
+        # chunks such as a ChunkedDataset, in which case 'y' is unused;
+        # a one-shot iterator of chunks can only be read once
+        X = self._as_source(X)
+        if isinstance(X, np.ndarray) and y is None:
+            raise ValueError("Training on an array needs the targets y")
+        if epochs > 1 and not isinstance(X, np.ndarray) and iter(X) is X:
+            raise ValueError("An iterator of chunks can only be used for "
+                "a single epoch, use a ChunkedDataset instead")
+        callbacks = self._callbacks(callbacks, displayUpdate)
+        validation = self._validation(validation, validationSize)
 
         # loop over the desired number of epochs
         for epoch in np.arange(0, epochs):
-            # loop over each individual data point and train
-            # our network on it
-            for (x, target) in zip(X, y):
-                self.fit_partial(x, target)
+            started = time.perf_counter()
+            loss = 0.0
+            samples = 0
+
+            # loop over the data points in batches of 'batch_size' rows
+            # and train our network on each batch -- a batch size of 1
+            # is plain per-sample stochastic gradient descent; the loss
+            # of every batch comes from the forward pass of the step
+            for (ws, start, stop) in self._batches(X, y, batch_size,
+                    targets=True):
+                loss += self._train_step(ws)
+                samples += ws.rows
+
+            self._epoch_end(callbacks, epoch, started, samples, loss,
+                validation)
+
+    def _callbacks(self, callbacks, displayUpdate):
+        # the training callbacks, with a ProgressPrinter in front of
+        # them, unless 'displayUpdate' is 0 or None
+        callbacks = list(callbacks or [])
+        if displayUpdate:
+            callbacks.insert(0, ProgressPrinter(displayUpdate))
+        return callbacks
+
+    def _validation(self, validation, size):
+        # the validation set (X, y), subsampled to 'size' evenly spaced
+        # rows -- a view, so np.memmap validation sets are not read
+        if validation is None:
+            return None
+        (X, y) = validation
+        X = np.atleast_2d(X)
+        y = np.asarray(y).reshape(X.shape[0], -1)
+        if size and size < X.shape[0]:
+            step = X.shape[0] // size
+            X = X[::step][:size]
+            y = y[::step][:size]
+        return (X, y)
+
+    def _epoch_end(self, callbacks, epoch, started, samples, loss,
+            validation):
+        # collect the metrics of the epoch and hand them to every
+        # callback
+        seconds = time.perf_counter() - started
+        metrics = {
+            "epoch": int(epoch) + 1,
+            "samples": samples,
+            "epoch_time": seconds,
+            "samples_per_sec": samples / seconds if seconds > 0 else 0.0,
+            "loss": loss,
+            "mean_loss": loss / samples if samples else 0.0,
+        }
+        if validation is not None:
+            metrics["val_loss"] = self.calculate_loss(validation[0],
+                validation[1], addBias=True)
+        for callback in callbacks:
+            if hasattr(callback, "on_epoch_end"):
+                callback.on_epoch_end(self, metrics)
+            else:
+                callback(self, metrics)
+
+    def fit_parallel(self, X, y, epochs=1000, displayUpdate=100,
+            batch_size=32, processes=None, hogwild=False, average=True,
+            callbacks=None, validation=None, validationSize=None):
+        # data-parallel training: the rows of X and y are split into
+        # one contiguous shard per worker process; the weights, the
+        # data and one set of gradient buffers per shard live in shared
+        # memory, so nothing but (shard, row range) tasks is pickled
+        X = np.atleast_2d(X)
+        y = np.asarray(y).reshape(X.shape[0], -1)
+        if processes is None:
+            processes = os.cpu_count()
+        bounds = np.linspace(0, X.shape[0], min(processes, X.shape[0]) + 1)
+        shards = [(int(lo), int(hi)) for (lo, hi) in zip(bounds, bounds[1:])]
+        callbacks = self._callbacks(callbacks, displayUpdate)
+        validation = self._validation(validation, validationSize)
 
-            # check to see if we should display a training update
-            if epoch == 0 or (epoch + 1) % displayUpdate == 0:
-                loss = self.calculate_loss(X, y)
-                print("[INFO] epoch={}, loss={:.7f}".format(
-                    epoch + 1, loss))
+        blocks = []
+        original = self.W
+        try:
+            (W, Wspecs) = zip(*[_share(w, blocks) for w in self.W])
+            data = [_share(X.astype(self.dtype, copy=False), blocks),
+                _share(y.astype(self.dtype, copy=False), blocks)]
+            G = [zip(*[_share(np.zeros_like(w), blocks) for w in self.W])
+                for shard in shards]
+            (G, Gspecs) = zip(*G)
+
+            # train on the shared weights in this process as well, so
+            # the validation loss below sees the current values; the
+            # workspaces hold views of the old weights and are dropped
+            self.W = list(W)
+            self.workspaces = {}
+            state = dict((key, value) for (key, value) in
+                self.__dict__.items() if key not in ("W", "workspaces"))
+            initargs = (state, Wspecs, [spec for (a, spec) in data], Gspecs)
+
+            with Pool(len(shards), initializer=_parallel_init,
+                    initargs=initargs) as pool:
+                # loop over the desired number of epochs
+                for epoch in np.arange(0, epochs):
+                    started = time.perf_counter()
+                    loss = 0.0
+                    if hogwild:
+                        # every worker runs plain mini-batch training on
+                        # its shard, updating the shared weights in
+                        # place without any locking (Hogwild!)
+                        loss += sum(pool.map(_parallel_hogwild,
+                            [(lo, hi, batch_size) for (lo, hi) in shards]))
+                    else:
+                        # in every step every worker computes the
+                        # gradients of the next batch of its shard,
+                        # which are accumulated here into the gradients
+                        # of the first shard of the step and applied to
+                        # the weights; the shards differ in length by up
+                        # to one row, so the steps run to the longest of
+                        # them, and in the last step the first shards
+                        # may have no rows left
+                        longest = max(hi - lo for (lo, hi) in shards)
+                        for start in range(0, longest, batch_size):
+                            tasks = [(i, lo + start,
+                                min(lo + start + batch_size, hi))
+                                for (i, (lo, hi)) in enumerate(shards)
+                                if lo + start < hi]
+                            loss += sum(pool.map(_parallel_gradients, tasks))
+                            first = G[tasks[0][0]]
+                            for (i, lo, hi) in tasks[1:]:
+                                for layer in range(len(self.W)):
+                                    np.add(first[layer], G[i][layer],
+                                        out=first[layer])
+                            scale = -self.alpha
+                            if average:
+                                scale /= len(tasks)
+                            self._update(first, scale)
+
+                    self._epoch_end(callbacks, epoch, started, X.shape[0],
+                        loss, validation)
+        finally:
+            # copy the trained weights back out of shared memory and
+            # release the shared blocks
+            if self.W is not original:
+                for (w, shared) in zip(original, self.W):
+                    np.copyto(w, shared)
+                self.W = original
+                self.workspaces = {}
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
 
     def fit_partial(self, x, y):
-        # construct our list of output activations for each layer
-        # as our data point flows through the network; the first
-        # activation is a special case -- it's just the input
-        # feature vector itself
-        A = [np.atleast_2d(x)]
+        # 'x' is either a single data point or a batch of data points
+        # (one per row), in both cases including the bias column;
+        # copy it and the targets into the workspace for its shape
+        x = np.asarray(x)
+        rows = x.shape[0] if x.ndim == 2 else 1
+        ws = self.workspace(rows)
+        ws.X[...] = x
+        ws.Y[...] = y
+        return self._train_step(ws)
 
+    def _forward(self, ws):
         # FEEDFORWARD:
-        # loop over the layers in the network
-        for layer in np.arange(0, len(self.W)):
-            # feedforward the activation at the current layer by
-            # taking the dot product between the activation and
-            # the weight matrix -- this is called the "net input"
-            # to the current layer
-            net = A[layer].dot(self.W[layer])
-
-            # computing the "net output" is simply applying our
-            # nonlinear activation function to the net input
-            out = self.sigmoid(net)
-
-            # once we have the net output, add it to our list of
-            # activations
-            A.append(out)
+        # loop over the layers in the network; the input to the first
+        # layer is the input buffer, the input to every other layer is
+        # the activation of the layer before it
+        p = ws.X
+        for layer in range(len(self.W)):
+            # the "net input" to the current layer is the dot product
+            # between the activation and the weight matrix, written
+            # straight into the activation buffer of this layer, which
+            # then goes through the nonlinear activation function
+            np.dot(p, self.W[layer], out=ws.A[layer])
+            self.activations[layer].forward(ws.A[layer], ws.T[layer],
+                ws.C)
+            p = ws.A[layer]
+        return p
+
+    def _train_step(self, ws):
+        # compute the gradients for the batch in the workspace, then
+        # update the weights with them, and return the loss of the
+        # batch before the update
+        loss = self._gradients(ws)
+        self._update(ws.G, -self.alpha)
+        return loss
+
+    def _gradients(self, ws):
+        # run the forward pass over the batch in the workspace
+        A, D, T, G = ws.A, ws.D, ws.T, ws.G
+        self._forward(ws)
 
         # BACKPROPAGATION
-        # the first phase of backpropagation is to compute the
-        # difference between our *prediction* (the final output
-        # activation in the activations list) and the true target
-        # value
-        error = A[-1] - y
-
-        # from here, we need to apply the chain rule and build our
-        # list of deltas 'D'; the first entry in the deltas is
-        # simply the error of the output layer times the derivative
-        # of our activation function for the output value
-        D = [error * self.sigmoid_deriv(A[-1])]
-
-        # once you understand the chain rule it becomes super easy
-        # to implement with a 'for' loop -- simply loop over the
-        # layers in reverse order (ignoring the last two since we
-        # already have taken them into account)
-        for layer in np.arange(len(A) - 2, 0, -1):
-            # the delta for the current layer is equal to the delta
-            # of the *previous layer* dotted with the weight matrix
-            # of the current layer, followed by multiplying the delta
-            # by the derivative of the nonlinear activation function
-            # for the activations of the current layer
-            delta = D[-1].dot(self.W[layer].T)
-            delta = delta * self.sigmoid_deriv(A[layer])
-            D.append(delta)
-
-        # since we looped over our layers in reverse order we need to
-        # reverse the deltas
-        D = D[::-1]
+        # the delta of the output layer is the error of our prediction
+        # times the derivative of the activation function for the
+        # output values
+        np.subtract(A[-1], ws.Y, out=D[-1])
 
+        # the error is all it takes to get the loss of the batch, so
+        # the training loss is tracked without another forward pass
+        loss = 0.5 * float(np.vdot(D[-1], D[-1]))
+        self.activations[-1].backward(A[-1], D[-1], T[-1], ws.C)
+
+        # loop over the layers in reverse order; the delta for a layer
+        # is the delta of the layer after it dotted with the weight
+        # matrix of that layer, multiplied by the derivative of the
+        # activation function for the activations of this layer
+        for layer in range(len(self.W) - 1, 0, -1):
+            np.dot(D[layer], ws.WT[layer], out=D[layer - 1])
+            self.activations[layer - 1].backward(A[layer - 1],
+                D[layer - 1], T[layer - 1], ws.C)
+
+        # GRADIENTS
+        # the gradient of a weight matrix is the dot product of the
+        # layer input with the deltas of the layer, summed over the
+        # batch
+        for layer in range(len(self.W)):
+            np.dot(ws.inputsT[layer], D[layer], out=G[layer])
+        return loss
+
+    def _update(self, G, scale):
         # WEIGHT UPDATE PHASE
-        # loop over the layers
-        for layer in np.arange(0, len(self.W)):
-            # update our weights by taking the dot product of the layer
-            # activations with their respective deltas, then multiplying
-            # this value by some small learning rate and adding to our
-            # weight matrix -- this is where the actual "learning" takes
-            # place
-            self.W[layer] += -self.alpha * A[layer].T.dot(D[layer])
-
-    def predict(self, X, addBias=True):
-        # initialize the output prediction as the input features -- this
-        # value will be (forward) propagated through the network to
-        # obtain the final prediction
-        p = np.atleast_2d(X)
-
-        # check to see if the bias column should be added
-        if addBias:
-            # insert a column of 1's as the last entry in the feature
-            # matrix (bias)
-            p = np.c_[p, np.ones((p.shape[0]))]
-
-        # loop over our layers in the network
-        for layer in np.arange(0, len(self.W)):
+        # loop over the layers and add the gradients, multiplied by
+        # 'scale' -- the negative learning rate -- to the weights; the
+        # gradients are overwritten by the scaled values
+        scale = self.dtype.type(scale)
+        for layer in range(len(self.W)):
+            np.multiply(G[layer], scale, out=G[layer])
+            np.add(self.W[layer], G[layer], out=self.W[layer])
+
+    def _as_source(self, X):
+        # lists, tuples and arrays are data points, one per row; any
+        # other iterable is a source of chunks
+        if isinstance(X, (np.ndarray, list, tuple)):
+            return np.atleast_2d(X)
+        return X
+
+    def _chunks(self, X, y):
+        # a single array is one chunk -- it is only ever read batch by
+        # batch, so for an np.memmap only the rows of the current batch
+        # are paged into memory; chunk sources yield (X, y) tuples or,
+        # for prediction, bare feature matrices
+        if isinstance(X, np.ndarray):
+            yield (X, y)
+            return
+        for chunk in X:
+            if isinstance(chunk, tuple):
+                yield chunk
+            else:
+                yield (chunk, None)
+
+    def _batches(self, X, y, rows, addBias=True, targets=False):
+        # copy the data points of every chunk batch by batch into the
+        # workspace for the batch shape, and yield the workspace with
+        # the position of the batch in the data set; the peak memory
+        # is bounded by the chunk size, no widened copy of X is made;
+        # with 'targets', every chunk must come with its targets, the
+        # target buffer would hold stale values otherwise
+        offset = 0
+        for (Xc, yc) in self._chunks(X, y):
+            if targets and yc is None:
+                raise ValueError("A chunk of data points has no targets")
+            if yc is not None:
+                # make sure the targets are a matrix with one row per
+                # data point, so that slices of it line up with X
+                yc = np.asarray(yc).reshape(Xc.shape[0], -1)
+
+            for start in range(0, Xc.shape[0], rows):
+                stop = min(start + rows, Xc.shape[0])
+                ws = self.workspace(stop - start)
+
+                # check to see if the bias column should be added; if
+                # so, the batch only fills the feature columns of the
+                # input buffer, whose last column already holds the
+                # 1's (bias)
+                if addBias:
+                    np.copyto(ws.features, Xc[start:stop])
+                else:
+                    np.copyto(ws.X, Xc[start:stop])
+                if yc is not None:
+                    np.copyto(ws.Y, yc[start:stop])
+                yield (ws, offset + start, offset + stop)
+
+            offset += Xc.shape[0]
+
+    def predict(self, X, addBias=True, out=None):
+        # 'X' is an array of data points or a source of chunks (see
+        # 'fit'); the predictions are written to 'out' if given
+        X = self._as_source(X)
+        if out is None and isinstance(X, np.ndarray):
+            out = np.empty((X.shape[0], self.layers[-1]), dtype=self.dtype)
+        parts = []
+
+        # push the data points through the network in batches of at
+        # most 'predictRows' rows, using the workspace for each batch
+        for (ws, start, stop) in self._batches(X, None, self.predictRows,
+                addBias):
             # computing the output prediction is as simple as taking
-            # the dot product between the current activation value 'p'
+            # the dot product between the current activation value
             # and the weight matrix associated with the current layer,
             # then passing this value through a nonlinear activation
             # function
-            p = self.sigmoid(np.dot(p, self.W[layer]))
+            p = self._forward(ws)
+            if out is not None:
+                np.copyto(out[start:stop], p)
+            else:
+                parts.append(p.copy())
+
+        # the number of predictions from a chunk source is only known
+        # at the end
+        if out is None:
+            out = np.concatenate(parts) if parts else \
+                np.empty((0, self.layers[-1]), dtype=self.dtype)
 
         # return the predicted value
-        return p
+        return out
 
-    def calculate_loss(self, X, targets):
-        # make predictions for the input data points then compute
-        # the loss
-        targets = np.atleast_2d(targets)
-        predictions = self.predict(X, addBias=False)
-        loss = 0.5 * np.sum((predictions - targets) ** 2)
+    def calculate_loss(self, X, targets=None, addBias=False):
+        # make predictions for the input data points batch by batch,
+        # then add up the loss of every batch, using the scratch buffer
+        # of the output layer for the error
+        X = self._as_source(X)
+        if isinstance(X, np.ndarray) and targets is None:
+            raise ValueError("The loss of an array needs the targets")
+        loss = 0.0
+        for (ws, start, stop) in self._batches(X, targets,
+                self.predictRows, addBias, targets=True):
+            loss += squared_error(self._forward(ws), ws.Y, ws.T[-1])
 
         # return the loss
         return loss
 
+
+class BatchingPredictor:
+    """
+    Inference front end for a trained NeuralNetwork.
+
+    Single-row prediction requests from any number of threads or
+    asyncio tasks are collected into micro-batches of up to
+    'maxBatchSize' rows; a request waits at most 'maxLatency' seconds
+    for other requests to join its batch. Every batch is pushed through
+    the network with one matrix product per layer by one of 'threads'
+    serving threads, each with its own workspaces. The weights are
+    shared with the network as read-only views.
+
+    with BatchingPredictor(model) as predictor:
+        p = predictor.predict(x)               # from a thread
+        p = await predictor.predict_async(x)   # from a coroutine
+    """
+
+    def __init__(self, network, maxBatchSize=64, maxLatency=0.002,
+            threads=1):
+        # a network that shares the architecture, the activations and
+        # the weights of 'network', with weights that cannot be written
+        self.network = NeuralNetwork.__new__(NeuralNetwork)
+        self.network.__dict__.update(network.__dict__)
+        self.network.W = []
+        for w in network.W:
+            view = w.view()
+            view.flags.writeable = False
+            self.network.W.append(view)
+        self.network.workspaces = {}
+
+        self.maxBatchSize = maxBatchSize
+        self.maxLatency = maxLatency
+        self.requests = 0
+        self.batches = 0
+        self.queue = queue.Queue()
+        self.closed = False
+        # orders the requests before the shutdown sentinels
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._serve, daemon=True)
+            for i in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, x):
+        # queue a prediction request for the data point 'x' (without
+        # the bias) and return a concurrent.futures.Future for the
+        # prediction; a data point of the wrong size fails its own
+        # future only, not the batch it would have joined
+        future = Future()
+        x = np.asarray(x).reshape(-1)
+        if x.size != self.network.layers[0]:
+            future.set_running_or_notify_cancel()
+            future.set_exception(ValueError("Expected a data point with %d "
+                "features, got %d" % (self.network.layers[0], x.size)))
+            return future
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("BatchingPredictor is closed")
+            self.queue.put((x, future))
+        return future
+
+    def predict(self, x, timeout=None):
+        # the prediction for the data point 'x'; blocks the calling
+        # thread until its batch has been computed
+        return self.submit(x).result(timeout)
+
+    async def predict_async(self, x):
+        # the prediction for the data point 'x', for asyncio code
+        return await asyncio.wrap_future(self.submit(x))
+
+    def close(self):
+        # stop the serving threads once the queued requests are served
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            for thread in self.threads:
+                self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _serve(self):
+        # the loop of a serving thread; its workspaces are private, so
+        # the threads never share a buffer
+        workspaces = {}
+        running = True
+        while running:
+            request = self.queue.get()
+            if request is None:
+                return
+
+            # collect requests into the batch until it is full or the
+            # latency budget of its first request is spent
+            batch = [request]
+            deadline = time.perf_counter() + self.maxLatency
+            while len(batch) < self.maxBatchSize:
+                try:
+                    request = self.queue.get(
+                        timeout=max(deadline - time.perf_counter(), 0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    running = False
+                    break
+                batch.append(request)
+
+            # drop the requests that were cancelled while they waited
+            batch = [(x, future) for (x, future) in batch
+                if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            try:
+                ws = workspaces.get(len(batch))
+                if ws is None:
+                    ws = Workspace(self.network, len(batch))
+                    workspaces[len(batch)] = ws
+                for (i, (x, future)) in enumerate(batch):
+                    ws.features[i] = x
+                p = self.network._forward(ws)
+            except Exception as e:
+                for (x, future) in batch:
+                    future.set_exception(e)
+                continue
+
+            self.requests += len(batch)
+            self.batches += 1
+            for (i, (x, future)) in enumerate(batch):
+                future.set_result(p[i].copy())
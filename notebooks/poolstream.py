@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+"""
+Filename: poolstream.py
+
+Stream chunks of work through a multiprocessing pool with bounded memory,
+for corpusparser.py and morphanalyzer.py.
+
+streamChunks sends the chunks to the pool as long as less than
+maxPending are in flight or waiting to be returned, such that a corpus
+of any size can be streamed, and returns the results in the order of
+the chunks or as they are done.
+
+Example:
+
+	from poolstream import streamChunks
+
+	tasks = ((number, chunk) for (number, chunk) in enumerate(chunks))
+	for ((number, result), seconds) in streamChunks(pool, work, tasks, 8):
+		print(number, result, seconds)
+"""
+
+import queue
+import time
+
+
+def streamChunks(pool, function, tasks, maxPending, ordered=True):
+	"""Apply function to every task on the pool and generate the pairs
+	(result, seconds from sending the task to getting its result). The
+	first element of a task is its chunk number, counted from 0, and the
+	first element of its result is the same number. The results come in
+	the order of the chunk numbers or, with ordered=False, as they are
+	done. An exception in a worker is raised here."""
+	done = queue.Queue()
+	tasks = iter(tasks)
+	submitted = {}
+	finished = {}
+	following = 0   # the next chunk to return in order
+	exhausted = False
+	while True:
+		# send chunks as long as less than maxPending are out
+		while not exhausted and len(submitted) + len(finished) < maxPending:
+			task = next(tasks, None)
+			if task is None:
+				exhausted = True
+				break
+			submitted[task[0]] = time.time()
+			pool.apply_async(function, (task,), callback=done.put, error_callback=done.put)
+		if not submitted and not finished:
+			return
+		if ordered and following in finished:
+			following += 1
+			yield finished.pop(following - 1)
+			continue
+		item = done.get()
+		if isinstance(item, BaseException):
+			raise item
+		seconds = time.time() - submitted.pop(item[0])
+		if ordered:
+			if item[0] != following:
+				finished[item[0]] = (item, seconds)
+				continue
+			following += 1
+		yield (item, seconds)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+"""
+Filename: sentencegenerator.py
+
+Generate sentences and their trees from grammars read with grammar.PSG,
+for test corpora.
+
+The generator counts the derivations of every symbol with every number
+of words, memoized in a table that grows with the largest length asked
+for, and uses the counts to find the derivations: every derivation of
+the start symbol with n words has a number (rank) from 0 to count(n) - 1,
+and tree(n, rank) builds it without search (sentence(n, rank) only its
+words). This gives:
+
+sample(n): a derivation with n words, drawn uniformly from all of them,
+such that long and short rules are not preferred as in random expansion.
+
+enumerate(n): all the derivations with n words, one at a time, in the
+order of their ranks, with the memory of one tree.
+
+The counts are the numbers of derivations (trees), not of sentences:
+a sentence with several parses is generated with each of its trees.
+A grammar with unary or empty rule cycles that lead to infinitely many
+derivations of the same words raises ValueError for these lengths, the
+rules can be removed with grammartransform.
+
+Example:
+
+	from grammar import PSG
+	from sentencegenerator import SentenceGenerator
+
+	generator = SentenceGenerator(PSG("mygrammar.txt"))
+	print(generator.count(5))
+	for words in generator.generate(5, 1000000, seed=42):
+		print(" ".join(words))
+"""
+
+import random
+from bisect import bisect_right
+
+
+class SentenceGenerator:
+	"""
+	Sentence generator for a PSG, run on its compiled form.
+
+	counts: list with the number of the derivations of every non-terminal
+	for every length computed so far, counts[n][symbol].
+
+	suffixes: dictionary with the memoized numbers of the derivations of
+	the rest rhs[i:] of a rule with m words, (rule, i, m) -> number.
+
+	choices: dictionary with the memoized choices of the derivations, for
+	(symbol, m) the rules of a non-terminal with m words and for (rule, i,
+	m) the numbers of words of rhs[i], each with the number of the
+	derivations, added up, to find a rank with bisection.
+	"""
+
+	def __init__(self, grammar, start=None):
+		if hasattr(grammar, "compile"):
+			grammar = grammar.compile()
+		self.grammar = grammar
+		self.start = grammar.start if start is None else grammar.intern(start)
+		self.counts = []
+		self.final = 0   # the number of the lengths with final counts
+		self.suffixes = {}
+		self.choices = {}
+
+	def _symbolCount(self, symbol, length):
+		"""Return the number of the derivations of a symbol with length
+		words, from the counts computed so far."""
+		if symbol >= self.grammar.nonterminals:
+			return 1 if length == 1 else 0
+		return self.counts[length][symbol]
+
+	def _suffix(self, rule, i, length):
+		"""Return the number of the derivations of the symbols of a rule
+		from position i with length words. Only the values for the lengths
+		with final counts are memoized."""
+		key = (rule, i, length)
+		if key in self.suffixes:
+			return self.suffixes[key]
+		g = self.grammar
+		position = g.rhsStart[rule] + i
+		if position == g.rhsStart[rule + 1]:
+			return 1 if length == 0 else 0
+		symbol = g.rhs[position]
+		total = 0
+		for k in range(length + 1):
+			count = self._symbolCount(symbol, k)
+			if count:
+				total += count * self._suffix(rule, i + 1, length - k)
+		if length < self.final:
+			self.suffixes[key] = total
+		return total
+
+	def _extend(self, length):
+		"""Compute the counts up to length. The derivations of a length can
+		use others of the same length (by unary and empty rules), such that
+		the counts of a length are repeated until they do not change."""
+		g = self.grammar
+		while len(self.counts) <= length:
+			n = len(self.counts)
+			current = [0] * g.nonterminals
+			self.counts.append(current)
+			for rounds in range(g.nonterminals + 1):
+				following = [0] * g.nonterminals
+				for symbol in range(g.nonterminals):
+					for rule in g.getRules(symbol):
+						following[symbol] += self._suffix(rule, 0, n)
+				if following == current:
+					break
+				current = self.counts[n] = following
+			else:
+				del self.counts[n:]
+				raise ValueError("Infinitely many derivations with " + str(n) + " words (unary or empty rule cycles)")
+			self.final = n + 1
+
+	def count(self, length):
+		"""Return the number of the derivations of the start symbol with
+		length words."""
+		if self.start < 0:
+			return 0
+		self._extend(length)
+		return self.counts[length][self.start]
+
+	def tree(self, length, rank):
+		"""Return the derivation with the number rank (0 ... count(length) -
+		1) of the derivations with length words, as a tree of tuples (label,
+		children ...) with the words as leaves."""
+		return self._derive(length, rank, True)
+
+	def sentence(self, length, rank):
+		"""Return the list of the words of the derivation with the number
+		rank, without building its tree."""
+		return self._derive(length, rank, False)
+
+	def _derive(self, length, rank, trees):
+		"""Return the tree, or the list of the words, of a derivation."""
+		if not 0 <= rank < self.count(length):
+			raise IndexError("No derivation " + str(rank) + " with " + str(length) + " words")
+		g = self.grammar
+		(symbols, rhs, rhsStart, nonterminals) = (g.symbols, g.rhs, g.rhsStart, g.nonterminals)
+		words = []
+		# the open nodes: [label and children, rule, next position in the
+		# rule, words left, rank left]
+		stack = [[[symbols[self.start]]] + self._choose(self.start, length, rank)]
+		while True:
+			frame = stack[-1]
+			(node, rule, i, left, rank) = frame
+			position = rhsStart[rule] + i
+			if position == rhsStart[rule + 1]:
+				stack.pop()
+				if not trees:
+					if not stack:
+						return words
+				elif not stack:
+					return tuple(node)
+				else:
+					stack[-1][0].append(tuple(node))
+				continue
+			# find the number of words k of the next symbol and its rank
+			(totals, lengths, rests) = self._splits(rule, i, left)
+			j = bisect_right(totals, rank)
+			k = lengths[j]
+			(own, rank) = divmod(rank - (totals[j - 1] if j else 0), rests[j])
+			frame[2] = i + 1
+			frame[3] = left - k
+			frame[4] = rank
+			symbol = rhs[position]
+			if symbol >= nonterminals:
+				(node if trees else words).append(symbols[symbol])
+			else:
+				stack.append([[symbols[symbol]] if trees else None] + self._choose(symbol, k, own))
+
+	def _choose(self, symbol, length, rank):
+		"""Return the list [rule, 0, length, rank within the rule] for the
+		derivation rank of a non-terminal with length words."""
+		key = (symbol, length)
+		if key not in self.choices:
+			(totals, rules, total) = ([], [], 0)
+			for rule in self.grammar.getRules(symbol):
+				count = self._suffix(rule, 0, length)
+				if count:
+					total += count
+					totals.append(total)
+					rules.append(rule)
+			self.choices[key] = (totals, rules)
+		(totals, rules) = self.choices[key]
+		j = bisect_right(totals, rank)
+		return [rules[j], 0, length, rank - (totals[j - 1] if j else 0)]
+
+	def _splits(self, rule, i, length):
+		"""Return the added up numbers of the derivations of rhs[i:] of a rule
+		with length words, by the number of words of rhs[i], these numbers
+		of words, and the numbers of the derivations of the rest rhs[i +
+		1:]."""
+		key = (rule, i, length)
+		if key not in self.choices:
+			symbol = self.grammar.rhs[self.grammar.rhsStart[rule] + i]
+			(totals, lengths, rests, total) = ([], [], [], 0)
+			for k in range(length + 1):
+				count = self._symbolCount(symbol, k)
+				if count:
+					rest = self._suffix(rule, i + 1, length - k)
+					if rest:
+						total += count * rest
+						totals.append(total)
+						lengths.append(k)
+						rests.append(rest)
+			self.choices[key] = (totals, lengths, rests)
+		return self.choices[key]
+
+	def sample(self, length, rng=None):
+		"""Return a derivation with length words, drawn uniformly, or None
+		if there is none. rng is a random.Random, by default the module."""
+		count = self.count(length)
+		if count == 0:
+			return None
+		return self.tree(length, (rng or random).randrange(count))
+
+	def generate(self, length, number, seed=None, trees=False):
+		"""Return a generator over number sentences (lists of words), or
+		trees with trees=True, drawn uniformly from the derivations with
+		length words."""
+		rng = random.Random(seed)
+		count = self.count(length)
+		if count == 0:
+			return
+		for i in range(number):
+			yield self._derive(length, rng.randrange(count), trees)
+
+	def enumerate(self, length, trees=False):
+		"""Return a generator over the sentences (lists of words), or trees
+		with trees=True, of all the derivations with length words."""
+		for rank in range(self.count(length)):
+			yield self._derive(length, rank, trees)
+
+	def words(self, tree):
+		"""Return the list of the words of a tree."""
+		words = []
+		stack = [tree]
+		while stack:
+			x = stack.pop()
+			if isinstance(x, tuple):
+				stack.extend(reversed(x[1:]))
+			else:
+				words.append(x)
+		return words
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+
+"""
+Filename: topdownparser.py
+
+Agenda-based top-down parser for grammars read with grammar.PSG, the
+tdparse strategy of the notebook "Parsing Natural Language in Python"
+without recursion and without list slicing.
+
+A state of the parser is a goal, the stack of the symbols that still
+have to be found, and the position in the input. The goal is a linked
+list of cells (symbol, rest), interned to numbers for each parse, such
+that states share their goals, a rule expansion only pushes its
+right-hand-side, and goals are compared and hashed as integers. For every
+cell the number of the symbols that cannot derive the empty string and
+the length are kept with it. The states are kept in an explicit
+agenda, and the strategy decides which state is taken next:
+
+FIFO: breadth-first, the oldest state first.
+
+LIFO: depth-first, the newest state first, as backtracking.
+
+PRIORITY: best-first, the state with the lowest priority(position,
+count) first, by default the state that got furthest in the input, and
+of those the one with the shortest goal.
+
+A goal and position from which no parse can be found is remembered as
+failed, and a state with a failed goal and position is dropped at once.
+Rules are only expanded if they can start with the next word (by the
+left corners of the grammar), and goals with more symbols that cannot
+derive the empty string than words left are dropped. Left recursion
+through nullable symbols does not make goals longer in these symbols:
+a tree without cycles has at most n - position + 1 nested expansions of
+a non-terminal at the same position, the state for one more is dropped,
+as is a goal that comes back at the same position while its first symbol
+is still open, and trees with a node above another node with the same
+label and span (cycles, as cut in the parse forests) are skipped.
+
+Example:
+
+	from grammar import PSG
+	from topdownparser import TopDownParser, LIFO
+	from chartparser import treeToString
+
+	parser = TopDownParser(PSG("mygrammar.txt"), strategy=LIFO)
+	for tree in parser.parse("John loves Mary".split()):
+		print(treeToString(tree))
+"""
+
+import heapq
+from collections import deque
+
+
+FIFO = "fifo"
+LIFO = "lifo"
+PRIORITY = "priority"
+
+
+class TopDownState:
+	"""
+	A state of the parser: the goal, the position in the input, the state
+	it was made from (parent) and how: the number of the expanded rule, or
+	-(position + 1) for the word at position that was matched. pending is
+	the number of the states made from it that are not done yet, success
+	is True once a parse was found from it, cyclic is True if a state was
+	dropped below it by the cycle checks, which depend on its ancestors,
+	such that its goal and position are not remembered as failed.
+	"""
+
+	__slots__ = ("goal", "position", "parent", "rule", "pending", "success", "cyclic")
+
+	def __init__(self, goal, position, parent, rule):
+		self.goal = goal
+		self.position = position
+		self.parent = parent
+		self.rule = rule
+		self.pending = 0
+		self.success = False
+		self.cyclic = False
+
+
+class TopDownParser:
+	"""
+	Top-down parser for a PSG, run on its compiled form.
+
+	strategy: FIFO, LIFO or PRIORITY, with the function priority(position,
+	count) for PRIORITY, where count is the number of goal symbols that
+	cannot derive the empty string.
+
+	stats: dictionary with the statistics of the last parse: states (taken
+	from the agenda), expanded (rules), pruned (states with too many goal
+	symbols or cycles), failed (states with a goal and position that
+	failed before) and parses.
+	"""
+
+	def __init__(self, grammar, start=None, strategy=FIFO, priority=None):
+		if hasattr(grammar, "compile"):
+			grammar = grammar.compile()
+		if strategy not in (FIFO, LIFO, PRIORITY):
+			raise ValueError("Unknown strategy: " + str(strategy))
+		self.grammar = grammar
+		self.start = grammar.start if start is None else grammar.intern(start)
+		self.strategy = strategy
+		self.priority = priority or (lambda position, count: (-position, count))
+		self.stats = {}
+
+	def recognize(self, tokens):
+		"""Return True if the grammar accepts the list of tokens."""
+		for tree in self.parse(tokens):
+			return True
+		return False
+
+	def parse(self, tokens):
+		"""Return a generator over the parse trees of the list of tokens,
+		in the order in which the strategy finds them."""
+		return self._parse(tuple(tokens))
+
+	def _viable(self, rule, token):
+		"""Return True if a rule can derive a string that starts with token
+		(-1 at the end of the input or for an unknown word)."""
+		g = self.grammar
+		for i in range(g.rhsStart[rule], g.rhsStart[rule + 1]):
+			x = g.rhs[i]
+			if x == token or token in g.LC[x]:
+				return True
+			if not g.nullable[x]:
+				return False
+		return True
+
+	def _parse(self, words):
+		g = self.grammar
+		tokens = [g.intern(x) for x in words]
+		n = len(tokens)
+		stats = self.stats = {"states": 0, "expanded": 0, "pruned": 0, "failed": 0, "parses": 0}
+		if self.start < 0:
+			return
+		failed = set()
+
+		# the interned goal cells: (symbol, rest) -> number, with the symbol,
+		# rest, count and length of the goal of every number; 0 is the empty
+		# goal
+		cells = {}
+		cellSymbol = [-1]
+		cellRest = [0]
+		cellCount = [0]
+		cellLength = [0]
+
+		def cell(symbol, rest):
+			key = (symbol, rest)
+			number = cells.get(key)
+			if number is None:
+				number = cells[key] = len(cellSymbol)
+				cellSymbol.append(symbol)
+				cellRest.append(rest)
+				cellCount.append(cellCount[rest] + (0 if g.nullable[symbol] else 1))
+				cellLength.append(cellLength[rest] + 1)
+			return number
+
+		# the agenda, with push and pop for the strategy
+		if self.strategy == PRIORITY:
+			agenda = []
+			counter = [0]
+
+			def push(state):
+				counter[0] += 1
+				heapq.heappush(agenda, (self.priority(state.position, cellCount[state.goal]), counter[0], state))
+
+			def pop():
+				return heapq.heappop(agenda)[2]
+		else:
+			agenda = deque()
+			push = agenda.append
+			pop = agenda.popleft if self.strategy == FIFO else agenda.pop
+
+		def dead(state):
+			# the state is done without a parse: remember its goal and
+			# position as failed, and its parent, if it is done as well
+			while state is not None and not state.success:
+				if not state.cyclic:
+					failed.add((state.goal, state.position))
+				parent = state.parent
+				if parent is None:
+					return
+				parent.pending -= 1
+				parent.cyclic = parent.cyclic or state.cyclic
+				if parent.pending > 0:
+					return
+				state = parent
+
+		push(TopDownState(cell(self.start, 0), 0, None, None))
+		while agenda:
+			state = pop()
+			stats["states"] += 1
+			goal = state.goal
+			position = state.position
+			if (goal, position) in failed:
+				stats["failed"] += 1
+				dead(state)
+				continue
+			if goal == 0:
+				tree = self._tree(state, words) if position == n else None
+				if tree is None:
+					# a cyclic tree depends on the ancestors, it is not a
+					# failure of the goal
+					state.cyclic = position == n
+					dead(state)
+					continue
+				stats["parses"] += 1
+				x = state
+				while x is not None and not x.success:
+					x.success = True
+					x = x.parent
+				yield tree
+				continue
+			symbol = cellSymbol[goal]
+			rest = cellRest[goal]
+			if symbol >= g.nonterminals:
+				# match the word
+				if position < n and tokens[position] == symbol:
+					state.pending = 1
+					push(TopDownState(rest, position + 1, state, -(position + 1)))
+				else:
+					dead(state)
+				continue
+			# the ancestors that consumed no input: the open expansions of
+			# the symbol at this position (an ancestor's symbol is open while
+			# the goals after it are not shorter than its goal), and the
+			# same goal with its symbol still open, i.e. the same node again
+			# (a cycle of unary and empty rules); an equal goal after a
+			# shorter one is another node, whose rest is another part of
+			# the tree
+			nested = 0
+			shortest = cellLength[goal]
+			repeated = False
+			ancestor = state.parent
+			while ancestor is not None and ancestor.position == position:
+				if cellSymbol[ancestor.goal] == symbol and shortest >= cellLength[ancestor.goal]:
+					if ancestor.goal == goal:
+						repeated = True
+						break
+					nested += 1
+				shortest = min(shortest, cellLength[ancestor.goal])
+				ancestor = ancestor.parent
+			# the nested expansions of a symbol at a position in a tree
+			# without cycles end at different positions, so there are at
+			# most n - position + 1 of them
+			if repeated or nested > n - position:
+				stats["pruned"] += 1
+				state.cyclic = True
+				dead(state)
+				continue
+			# expand the non-terminal with the rules that can start with the
+			# next word, in the order of the grammar for LIFO too
+			token = tokens[position] if position < n else -1
+			children = []
+			for rule in g.getRules(symbol):
+				if not self._viable(rule, token):
+					continue
+				following = rest
+				for i in range(g.rhsStart[rule + 1] - 1, g.rhsStart[rule] - 1, -1):
+					following = cell(g.rhs[i], following)
+				if cellCount[following] > n - position:
+					stats["pruned"] += 1
+					continue
+				children.append(TopDownState(following, position, state, rule))
+			stats["expanded"] += len(children)
+			if not children:
+				dead(state)
+				continue
+			state.pending = len(children)
+			if self.strategy == LIFO:
+				children.reverse()
+			for child in children:
+				push(child)
+
+	def _tree(self, state, words):
+		"""Return the tree of the derivation that led to a state, from the
+		rules and word matches of the states along its parents, or None if
+		a node of the tree has a descendant with the same label and span
+		(a cycle)."""
+		g = self.grammar
+		actions = []
+		while state.parent is not None:
+			actions.append(state.rule)
+			state = state.parent
+		actions.reverse()
+		# the open nodes: [label and children, number of missing children,
+		# start, labels of the descendants by span of the children]; the
+		# closed items: (tree, start, end, labels of the nodes with its span)
+		stack = []
+		tree = None
+		position = 0
+		for rule in actions:
+			if rule < 0:
+				item = (words[-rule - 1], position, position + 1, ())
+				position += 1
+			else:
+				stack.append([[g.symbols[g.ruleLHS[rule]]], g.ruleLength(rule), position, []])
+				if g.ruleLength(rule) > 0:
+					continue
+				frame = stack.pop()
+				item = (tuple(frame[0]), position, position, (frame[0][0],))
+			while stack:
+				frame = stack[-1]
+				frame[0].append(item[0])
+				frame[3].append(item[1:])
+				frame[1] -= 1
+				if frame[1] > 0:
+					break
+				stack.pop()
+				# the descendants with the span of the node are in the
+				# children with its span
+				same = set()
+				for (start, end, labels) in frame[3]:
+					if start == frame[2] and end == position:
+						same.update(labels)
+				label = frame[0][0]
+				if label in same:
+					return None
+				same.add(label)
+				item = (tuple(frame[0]), frame[2], position, same)
+			else:
+				tree = item[0]
+		return tree